@@ -11,14 +11,17 @@ import copy, math, os, sys, time
 from ij import IJ, ImageStack, ImagePlus
 from ij.measure import ResultsTable
 from ij.plugin import ChannelSplitter, RGBStackMerge, Commands
-from java.lang import Runtime
-from java.util import ArrayList
+from ij.plugin.filter import ThresholdToSelection
+from ij.process import Blitter, ByteProcessor, FloatProcessor, ImageProcessor, ShortProcessor
+from ch.systemsx.cisd.hdf5 import HDF5Factory
+from java.lang import Float, Runtime
+from java.util import ArrayList, Arrays
+from jarray import array, zeros
 from mcib3d.image3d import ImageHandler, ImageInt
 from mcib3d.image3d.processing import FastFilters3D
 from mcib3d.image3d.regionGrowing import Watershed3D
 from mcib3d.geom import Voxel3D
 from mcib3d.geom import Object3DVoxels
-from mcib3d.geom import Objects3DPopulation
 from net.imagej import Dataset, ImgPlus
 from net.imglib2.algorithm.gauss import Gauss
 from net.imglib2.img.array import ArrayImgFactory
@@ -26,48 +29,189 @@ from net.imglib2.type.numeric.real import FloatType
 from sc.fiji.hdf5 import HDF5ImageJ
 
 
-def readVoxels(imp):
-    image = ImageInt.wrap(imp)
-    minX = 0
-    maxX = image.sizeX
-    minY = 0
-    maxY = image.sizeY
-    minZ = 0
-    maxZ = image.sizeZ
-    minV = int(image.getMinAboveValue(0))
-    maxV = int(image.getMax())
-    voxels = []
-    for i in range(0, maxV - minV + 1):
-        vlist = ArrayList()
-        voxels.append(vlist)
-    for k in range(minZ, maxZ):
-        for j in range(minY, maxY):
-            for i in range(minX, maxX):
-                pixel = image.getPixel(i, j, k)
-                if pixel > 0:
-                    voxel = Voxel3D(i, j, k, pixel)
-                    oid = int(pixel) - minV
-                    voxels[oid].add(voxel)
-    objectVoxels = []
-    for i in range(0, maxV - minV + 1):
-        if voxels[i]:
-            objectVoxels.append(voxels[i])
-    return objectVoxels
-
-### Create objects from label image voxels
-def addVoxels(objectVoxels, imagePlus):
-    objects = Objects3DPopulation()
-    image = ImageInt.wrap(imagePlus)
-    calibration = image.getCalibration();
-    for voxels in objectVoxels:
-        if voxels:
-            objectV = Object3DVoxels(voxels)
-            objectV.setCalibration(calibration)
-            objectV.setLabelImage(image)
+### Label values of the raw plane pixels readPlanes yields (byte, short, float or int arrays) as a float plane
+def labelProcessor(pixels, sizeX, sizeY):
+    if pixels.typecode == 'b':
+        return ByteProcessor(sizeX, sizeY, pixels).convertToFloat()
+    if pixels.typecode == 'h':
+        return ShortProcessor(sizeX, sizeY, pixels, None).convertToFloat()
+    return FloatProcessor(sizeX, sizeY, pixels)
+
+### Runs (label, y, x_start, x_end) of a label plane, found on the Java side: the pixels that differ from their
+### left neighbour start a run and are listed by ThresholdToSelection, so Jython only visits the run starts
+def planeRuns(ip):
+    (sizeX, sizeY) = (ip.getWidth(), ip.getHeight())
+    starts = FloatProcessor(sizeX, sizeY)
+    starts.copyBits(ip, 1, 0, Blitter.COPY)
+    starts.copyBits(ip, 0, 0, Blitter.DIFFERENCE)
+    starts.setThreshold(0.5, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+    roi = ThresholdToSelection().convert(starts)
+    if roi is None:
+        return []
+    points = sorted([(point.y, point.x) for point in roi.getContainedPoints()])
+    runs = []
+    for index, (y, x) in enumerate(points):
+        label = int(ip.getf(x, y))
+        if label:
+            if index + 1 < len(points) and points[index + 1][0] == y:
+                end = points[index + 1][1] - 1
+            else:
+                end = sizeX - 1
+            runs.append((label, y, x, end))
+    return runs
+
+### Yield (k, plane) for planes zmin..zmax of an ImageStack or of a zyx HDF5 dataset given as (file, dataset).
+### Datasets are read in slabs of the given depth, as float values or as int labels.
+def readPlanes(source, zmin, zmax, depth, asFloat):
+    if isinstance(source, ImageStack):
+        for k in range(zmin, zmax):
+            if asFloat:
+                yield k, source.getProcessor(k + 1).convertToFloat().getPixels()
+            else:
+                yield k, source.getPixels(k + 1)
+        return
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = [int(size) for size in reader.object().getDimensions(dataset)]
+        planeSize = sizeX * sizeY
+        for z0 in range(zmin, zmax, depth):
+            z1 = min(z0 + depth, zmax)
+            size = array([z1 - z0, sizeY, sizeX], 'i')
+            offset = array([z0, 0, 0], 'l')
+            if asFloat:
+                block = reader.float32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            else:
+                block = reader.int32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            for k in range(z0, z1):
+                start = (k - z0) * planeSize
+                yield k, Arrays.copyOfRange(block, start, start + planeSize)
+    finally:
+        reader.close()
+
+def sourceDimensions(source):
+    if isinstance(source, ImageStack):
+        return (source.getWidth(), source.getHeight(), source.getSize())
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = reader.object().getDimensions(dataset)
+    finally:
+        reader.close()
+    return (int(sizeX), int(sizeY), int(sizeZ))
+
+### Counting sort of the first count labels: the labels present, the offsets of their groups and the
+### position of every item in label order, from the label histogram
+def sortLabels(labels, count):
+    maxV = max(labels[0:count]) if count else 0
+    counts = zeros(maxV + 1, 'i')
+    for index in range(0, count):
+        counts[labels[index]] += 1
+    present = [label for label in range(1, maxV + 1) if counts[label]]
+    offsets = zeros(len(present) + 1, 'i')
+    fill = zeros(maxV + 1, 'i')
+    for index, label in enumerate(present):
+        fill[label] = offsets[index]
+        offsets[index + 1] = offsets[index] + counts[label]
+    positions = zeros(count, 'i')
+    for index in range(0, count):
+        positions[index] = fill[labels[index]]
+        fill[labels[index]] += 1
+    return present, offsets, positions
+
+### Run-length encoded objects of a label image, runs of (z, y, x_start, x_end) grouped by label
+### LabelRuns and its helpers are kept identical in dog-segment*.py, median.py and segmentation.py
+class LabelRuns():
+    def __init__(self, planes, sizeX, sizeY, calibration):
+        self.calibration = calibration
+        self.__scan(planes, sizeX, sizeY)
+        self.__sort()
+
+    @classmethod
+    def fromImage(self, imp):
+        stack = imp.getImageStack()
+        planes = readPlanes(stack, 0, stack.getSize(), 1, False)
+        return self(planes, stack.getWidth(), stack.getHeight(), imp.getCalibration())
+
+    ### Stream the label dataset in z-slabs; runs never cross planes, so objects spanning slabs just collect more runs
+    @classmethod
+    def fromHDF5(self, hdf5, dataset, depth, calibration):
+        source = (hdf5, dataset)
+        (sizeX, sizeY, sizeZ) = sourceDimensions(source)
+        planes = readPlanes(source, 0, sizeZ, depth, False)
+        return self(planes, sizeX, sizeY, calibration)
+
+    def __scan(self, planes, sizeX, sizeY):
+        capacity = sizeY
+        labels, z, y, x0, x1 = [zeros(capacity, 'i') for column in range(0, 5)]
+        count = 0
+        for k, pixels in planes:
+            runs = planeRuns(labelProcessor(pixels, sizeX, sizeY))
+            if count + len(runs) > capacity:
+                capacity = 2 * capacity + len(runs)
+                labels, z, y, x0, x1 = [Arrays.copyOf(column, capacity) for column in [labels, z, y, x0, x1]]
+            for (label, j, start, end) in runs:
+                labels[count] = label
+                z[count] = k
+                y[count] = j
+                x0[count] = start
+                x1[count] = end
+                count += 1
+        self.runs = (count, labels, z, y, x0, x1)
+
+    def __sort(self):
+        count, labels, z, y, x0, x1 = self.runs
+        present, self.offsets, positions = sortLabels(labels, count)
+        self.labels = array(present, 'i')
+        self.z, self.y, self.x0, self.x1 = [zeros(count, 'i') for column in range(0, 4)]
+        for run in range(0, count):
+            position = positions[run]
+            self.z[position] = z[run]
+            self.y[position] = y[run]
+            self.x0[position] = x0[run]
+            self.x1[position] = x1[run]
+        self.runs = None
+
+    def size(self):
+        return len(self.labels)
+
+    def getLabel(self, index):
+        return self.labels[index]
+
+    def getVolume(self, index):
+        volume = 0
+        for run in range(self.offsets[index], self.offsets[index + 1]):
+            volume += self.x1[run] - self.x0[run] + 1
+        return volume
+
+    ### Bounding box of an object as (x, y, z, width, height, depth)
+    def getBounds(self, index):
+        (first, last) = (self.offsets[index], self.offsets[index + 1])
+        (xmin, ymin, zmin) = (min(self.x0[first:last]), min(self.y[first:last]), min(self.z[first:last]))
+        (xmax, ymax, zmax) = (max(self.x1[first:last]), max(self.y[first:last]), max(self.z[first:last]))
+        return (xmin, ymin, zmin, xmax - xmin + 1, ymax - ymin + 1, zmax - zmin + 1)
+
+    def getVoxels(self, index):
+        label = self.labels[index]
+        voxels = ArrayList(self.getVolume(index))
+        for run in range(self.offsets[index], self.offsets[index + 1]):
+            for i in range(self.x0[run], self.x1[run] + 1):
+                voxels.add(Voxel3D(i, self.y[run], self.z[run], label))
+        return voxels
+
+    ### Build the mcib3d object on demand; contours use the label image when given, the object's own voxels otherwise
+    def getObject(self, index, contours = False, labelImage = None):
+        objectV = Object3DVoxels(self.getVoxels(index))
+        objectV.setCalibration(self.calibration)
+        if contours:
+            objectV.setLabelImage(labelImage)
             objectV.computeContours()
             objectV.setLabelImage(None)
-            objects.addObject(objectV)
-    return objects
+        return objectV
+
+    def getObjects(self, contours = False, labelImage = None):
+        for index in range(0, self.size()):
+            yield self.getObject(index, contours, labelImage)
 
 def getMeasurements(objects, image):
     imageChannels = []
@@ -79,7 +223,7 @@ def getMeasurements(objects, image):
     results = ResultsTable()
     results.showRowNumbers(False)
 
-    for index, objectV in enumerate(objects.getObjectsList()):
+    for index, objectV in enumerate(objects):
         results.incrementCounter()
         results.addValue("Particle", index + 1)
         results.addValue("cx", objectV.getCenterX())
@@ -121,12 +265,12 @@ def watershed(mask, seeds):
     return watershed
 
 def segment(watershed):
-    objects = addVoxels(readVoxels(watershed), watershed)
-    return objects
+    runs = LabelRuns.fromImage(watershed)
+    return runs
 
 def measurements(image, watershed):
-    objects = segment(watershed)
-    measurements = getMeasurements(objects, image)
+    runs = segment(watershed)
+    measurements = getMeasurements(runs.getObjects(True, ImageInt.wrap(watershed)), image)
     return measurements
 
 
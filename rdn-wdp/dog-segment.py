@@ -1,126 +1,1438 @@
 # @File(label="Input image") inputfile
+# @String(label="Task",choices={"segment", "measure", "append"},value="segment") task
 # @File(label="Output HDF5 name", value="") outputfile
 # @File(label="Training data (specify to run ML)", value="") model
 # @Integer(label="Probability map index", value=1) pmapidx
 # @String(label="Segmentation dataset", value="/raw/fused/channel1") dsegm
 # @String(label="Measurement datasets", value="/raw/fused/channel0, /raw/fused/channel2, /raw/fused/channel1") dmeas
-# @Integer(label="DoG sigma",value=18) sigma
+# @Float(label="DoG sigma",value=18) sigma
 # @Float(label="DoG ratio",value=4.0) div
-# @Integer(label="Local maxima radius",value=3) radius
+# @String(label="DoG mode",choices={"exact", "recursive", "pyramid", "fft", "auto"},value="auto") dogmode
+# @Float(label="DoG pyramid tolerance",value=0.01) dogtol
+# @Float(label="Local maxima radius",value=3) radius
+# @Boolean(label="Sigma and radius in calibrated units",value=false) calibrated
+# @String(label="Local maxima neighbourhood",choices={"ellipsoid", "box", "approx"},value="ellipsoid") neighbourhood
 # @Float(label="Maxima cutoff",value=0.0) cutoff
+# @File(label="Peak cache (specify to reuse the DoG and maxima across cutoffs)", value="") peakcache
+# @String(label="Measurement profile",value="centroid, volume, intensity, neighbours") profile
+# @String(label="Neighbour radii",value="10, 20") nradii
+# @Integer(label="Measurement slab depth",value=8) slab
+# @Boolean(label="Save the DoG to /watershed/dog",value=true) savedog
+# @Integer(label="DoG tile size (0 for the whole volume, tiles of 256 when the DoG is not saved)",value=0) dogtile
+# @String(label="DoG storage",choices={"float32", "int16"},value="float32") dogstorage
+# @String(label="Watershed engine",choices={"mcib3d", "queue"},value="mcib3d") wsengine
+# @Integer(label="Watershed levels",value=256) wslevels
+# @Boolean(label="Flood mask components in parallel",value=false) wsparallel
+# @Boolean(label="Stream measurements from HDF5",value=false) stream
+# @Integer(label="Number of z slabs (segment one slab per run, stitch with dog-stitch.py)",value=1) nslabs
+# @Integer(label="Slab index",value=0) slabindex
+# @Integer(label="Slab overlap in planes (0 for 3 DoG sigmas plus the maxima radius)",value=0) slaboverlap
+# @Integer(label="Threads",value=0) ncpus
 # @ConvertService convert
 # @DatasetService ds
 # @DisplayService display
 # @OpService ops
 
 import copy, math, os, sys, time
+from itertools import izip
 from ij import IJ, ImageStack, ImagePlus
-from ij.measure import ResultsTable
-from ij.plugin import ChannelSplitter, HyperStackConverter, RGBStackMerge, Commands
-from java.lang import Runtime
-from java.util import ArrayList
-from mcib3d.image3d import ImageHandler, ImageInt
-from mcib3d.image3d.processing import FastFilters3D
+from ij.measure import Calibration, ResultsTable
+from ij.plugin import Binner, ChannelSplitter, HyperStackConverter, RGBStackMerge, Commands
+from ij.plugin.filter import ThresholdToSelection
+from ij.process import Blitter, ByteProcessor, FloatProcessor, ImageProcessor, ShortProcessor, StackStatistics
+from ij.util import Tools
+from ch.systemsx.cisd.base.mdarray import MDFloatArray, MDShortArray
+from ch.systemsx.cisd.hdf5 import HDF5Factory, HDF5FloatStorageFeatures, HDF5IntStorageFeatures
+from java.lang import Double, Float, Integer, Math, Runtime, String, System
+from java.util import ArrayList, Arrays
+from java.util.concurrent import Callable, Executors
+from java.util.concurrent.locks import ReentrantLock
+from jarray import array, zeros
+from mcib3d.image3d import ImageHandler, ImageInt, ImageLabeller
 from mcib3d.image3d.regionGrowing import Watershed3D
 from mcib3d.geom import Voxel3D
 from mcib3d.geom import Object3DVoxels
-from mcib3d.geom import Objects3DPopulation
 from net.imagej import Dataset, ImgPlus
+from net.imglib2 import FinalDimensions
 from net.imglib2.algorithm.gauss import Gauss
-from net.imglib2.img.array import ArrayImgFactory
+from net.imglib2.algorithm.gauss3 import Gauss3
+from net.imglib2.img.array import ArrayImgFactory, ArrayImgs
+from net.imglib2.algorithm.fft2 import FFT, FFTMethods
+from net.imglib2.img.display.imagej import ImageJFunctions
+from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
+from net.imglib2.realtransform import AffineTransform3D, RealViews
+from net.imglib2.roi.labeling import ImgLabeling
+from net.imglib2.type.numeric.complex import ComplexFloatType
 from net.imglib2.type.numeric.real import FloatType
 from net.imglib2.type.numeric.integer import UnsignedShortType
+from net.imglib2.util import Intervals
+from net.imglib2.view import Views
 from sc.fiji.hdf5 import HDF5ImageJ
 from trainableSegmentation import WekaSegmentation
 
 
-def readVoxels(imp):
-    image = ImageInt.wrap(imp)
-    minX = 0
-    maxX = image.sizeX
-    minY = 0
-    maxY = image.sizeY
-    minZ = 0
-    maxZ = image.sizeZ
-    minV = int(image.getMinAboveValue(0))
-    maxV = int(image.getMax())
-    voxels = []
-    for i in range(0, maxV - minV + 1):
-        vlist = ArrayList()
-        voxels.append(vlist)
-    for k in range(minZ, maxZ):
-        for j in range(minY, maxY):
-            for i in range(minX, maxX):
-                pixel = image.getPixel(i, j, k)
-                if pixel > 0:
-                    voxel = Voxel3D(i, j, k, pixel)
-                    oid = int(pixel) - minV
-                    voxels[oid].add(voxel)
-    objectVoxels = []
-    for i in range(0, maxV - minV + 1):
-        if voxels[i]:
-            objectVoxels.append(voxels[i])
-    return objectVoxels
-
-### Create objects from label image voxels
-def addVoxels(objectVoxels, imagePlus):
-    objects = Objects3DPopulation()
-    image = ImageInt.wrap(imagePlus)
-    calibration = image.getCalibration();
-    for voxels in objectVoxels:
-        if voxels:
-            objectV = Object3DVoxels(voxels)
-            objectV.setCalibration(calibration)
-            objectV.setLabelImage(image)
+### Label values of the raw plane pixels readPlanes yields (byte, short, float or int arrays) as a float plane
+def labelProcessor(pixels, sizeX, sizeY):
+    if pixels.typecode == 'b':
+        return ByteProcessor(sizeX, sizeY, pixels).convertToFloat()
+    if pixels.typecode == 'h':
+        return ShortProcessor(sizeX, sizeY, pixels, None).convertToFloat()
+    return FloatProcessor(sizeX, sizeY, pixels)
+
+### Runs (label, y, x_start, x_end) of a label plane, found on the Java side: the pixels that differ from their
+### left neighbour start a run and are listed by ThresholdToSelection, so Jython only visits the run starts
+def planeRuns(ip):
+    (sizeX, sizeY) = (ip.getWidth(), ip.getHeight())
+    starts = FloatProcessor(sizeX, sizeY)
+    starts.copyBits(ip, 1, 0, Blitter.COPY)
+    starts.copyBits(ip, 0, 0, Blitter.DIFFERENCE)
+    starts.setThreshold(0.5, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+    roi = ThresholdToSelection().convert(starts)
+    if roi is None:
+        return []
+    points = sorted([(point.y, point.x) for point in roi.getContainedPoints()])
+    runs = []
+    for index, (y, x) in enumerate(points):
+        label = int(ip.getf(x, y))
+        if label:
+            if index + 1 < len(points) and points[index + 1][0] == y:
+                end = points[index + 1][1] - 1
+            else:
+                end = sizeX - 1
+            runs.append((label, y, x, end))
+    return runs
+
+### Yield (k, plane) for planes zmin..zmax of an ImageStack or of a zyx HDF5 dataset given as (file, dataset).
+### Datasets are read in slabs of the given depth, as float values or as int labels.
+def readPlanes(source, zmin, zmax, depth, asFloat):
+    if isinstance(source, ImageStack):
+        for k in range(zmin, zmax):
+            if asFloat:
+                yield k, source.getProcessor(k + 1).convertToFloat().getPixels()
+            else:
+                yield k, source.getPixels(k + 1)
+        return
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = [int(size) for size in reader.object().getDimensions(dataset)]
+        planeSize = sizeX * sizeY
+        for z0 in range(zmin, zmax, depth):
+            z1 = min(z0 + depth, zmax)
+            size = array([z1 - z0, sizeY, sizeX], 'i')
+            offset = array([z0, 0, 0], 'l')
+            if asFloat:
+                block = reader.float32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            else:
+                block = reader.int32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            for k in range(z0, z1):
+                start = (k - z0) * planeSize
+                yield k, Arrays.copyOfRange(block, start, start + planeSize)
+    finally:
+        reader.close()
+
+def sourceDimensions(source):
+    if isinstance(source, ImageStack):
+        return (source.getWidth(), source.getHeight(), source.getSize())
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = reader.object().getDimensions(dataset)
+    finally:
+        reader.close()
+    return (int(sizeX), int(sizeY), int(sizeZ))
+
+### Voxel size of an HDF5 dataset from its element_size_um attribute (zyx), uncalibrated when it has none
+def datasetCalibration(hdf5, dataset):
+    calibration = Calibration()
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        if reader.object().hasAttribute(dataset, "element_size_um"):
+            (calibration.pixelDepth, calibration.pixelHeight, calibration.pixelWidth) = reader.float32().getArrayAttr(dataset, "element_size_um")
+            calibration.setUnit("micron")
+    finally:
+        reader.close()
+    return calibration
+
+### Core planes of z slab index out of n and the planes it is segmented over, grown by the overlap on both sides
+def slabExtent(sizeZ, n, index, overlap):
+    core = (sizeZ * index / n, sizeZ * (index + 1) / n)
+    return core, (max(0, core[0] - overlap), min(sizeZ, core[1] + overlap))
+
+### Planes zmin..zmax of an HDF5 dataset as a calibrated float image
+def readSlab(hdf5, dataset, zmin, zmax):
+    (sizeX, sizeY, sizeZ) = sourceDimensions((hdf5, dataset))
+    stack = ImageStack(sizeX, sizeY)
+    for (k, pixels) in readPlanes((hdf5, dataset), zmin, zmax, slab, True):
+        stack.addSlice(FloatProcessor(sizeX, sizeY, pixels))
+    imp = ImagePlus(dataset, stack)
+    imp.setCalibration(datasetCalibration(hdf5, dataset))
+    return imp
+
+### Records where the labels of a slab sit in the whole volume, for dog-stitch.py
+def saveSlabAttributes(hdf5, dataset, core, extent, sizeZ, maxLabel):
+    writer = HDF5Factory.open(hdf5)
+    try:
+        writer.int32().setArrayAttr(dataset, "slab_core", array(core, 'i'))
+        writer.int32().setArrayAttr(dataset, "slab_extent", array(extent, 'i'))
+        writer.int32().setAttr(dataset, "volume_depth", sizeZ)
+        writer.int32().setAttr(dataset, "max_label", maxLabel)
+    finally:
+        writer.close()
+
+### Counting sort of the first count labels: the labels present, the offsets of their groups and the
+### position of every item in label order, from the label histogram
+def sortLabels(labels, count):
+    maxV = max(labels[0:count]) if count else 0
+    counts = zeros(maxV + 1, 'i')
+    for index in range(0, count):
+        counts[labels[index]] += 1
+    present = [label for label in range(1, maxV + 1) if counts[label]]
+    offsets = zeros(len(present) + 1, 'i')
+    fill = zeros(maxV + 1, 'i')
+    for index, label in enumerate(present):
+        fill[label] = offsets[index]
+        offsets[index + 1] = offsets[index] + counts[label]
+    positions = zeros(count, 'i')
+    for index in range(0, count):
+        positions[index] = fill[labels[index]]
+        fill[labels[index]] += 1
+    return present, offsets, positions
+
+### Run-length encoded objects of a label image, runs of (z, y, x_start, x_end) grouped by label
+### LabelRuns and its helpers are kept identical in dog-segment*.py, median.py and segmentation.py
+class LabelRuns():
+    def __init__(self, planes, sizeX, sizeY, calibration):
+        self.calibration = calibration
+        self.__scan(planes, sizeX, sizeY)
+        self.__sort()
+
+    @classmethod
+    def fromImage(self, imp):
+        stack = imp.getImageStack()
+        planes = readPlanes(stack, 0, stack.getSize(), 1, False)
+        return self(planes, stack.getWidth(), stack.getHeight(), imp.getCalibration())
+
+    ### Stream the label dataset in z-slabs; runs never cross planes, so objects spanning slabs just collect more runs
+    @classmethod
+    def fromHDF5(self, hdf5, dataset, depth, calibration):
+        source = (hdf5, dataset)
+        (sizeX, sizeY, sizeZ) = sourceDimensions(source)
+        planes = readPlanes(source, 0, sizeZ, depth, False)
+        return self(planes, sizeX, sizeY, calibration)
+
+    def __scan(self, planes, sizeX, sizeY):
+        capacity = sizeY
+        labels, z, y, x0, x1 = [zeros(capacity, 'i') for column in range(0, 5)]
+        count = 0
+        for k, pixels in planes:
+            runs = planeRuns(labelProcessor(pixels, sizeX, sizeY))
+            if count + len(runs) > capacity:
+                capacity = 2 * capacity + len(runs)
+                labels, z, y, x0, x1 = [Arrays.copyOf(column, capacity) for column in [labels, z, y, x0, x1]]
+            for (label, j, start, end) in runs:
+                labels[count] = label
+                z[count] = k
+                y[count] = j
+                x0[count] = start
+                x1[count] = end
+                count += 1
+        self.runs = (count, labels, z, y, x0, x1)
+
+    def __sort(self):
+        count, labels, z, y, x0, x1 = self.runs
+        present, self.offsets, positions = sortLabels(labels, count)
+        self.labels = array(present, 'i')
+        self.z, self.y, self.x0, self.x1 = [zeros(count, 'i') for column in range(0, 4)]
+        for run in range(0, count):
+            position = positions[run]
+            self.z[position] = z[run]
+            self.y[position] = y[run]
+            self.x0[position] = x0[run]
+            self.x1[position] = x1[run]
+        self.runs = None
+
+    def size(self):
+        return len(self.labels)
+
+    def getLabel(self, index):
+        return self.labels[index]
+
+    def getVolume(self, index):
+        volume = 0
+        for run in range(self.offsets[index], self.offsets[index + 1]):
+            volume += self.x1[run] - self.x0[run] + 1
+        return volume
+
+    ### Bounding box of an object as (x, y, z, width, height, depth)
+    def getBounds(self, index):
+        (first, last) = (self.offsets[index], self.offsets[index + 1])
+        (xmin, ymin, zmin) = (min(self.x0[first:last]), min(self.y[first:last]), min(self.z[first:last]))
+        (xmax, ymax, zmax) = (max(self.x1[first:last]), max(self.y[first:last]), max(self.z[first:last]))
+        return (xmin, ymin, zmin, xmax - xmin + 1, ymax - ymin + 1, zmax - zmin + 1)
+
+    def getVoxels(self, index):
+        label = self.labels[index]
+        voxels = ArrayList(self.getVolume(index))
+        for run in range(self.offsets[index], self.offsets[index + 1]):
+            for i in range(self.x0[run], self.x1[run] + 1):
+                voxels.add(Voxel3D(i, self.y[run], self.z[run], label))
+        return voxels
+
+    ### Build the mcib3d object on demand; contours use the label image when given, the object's own voxels otherwise
+    def getObject(self, index, contours = False, labelImage = None):
+        objectV = Object3DVoxels(self.getVoxels(index))
+        objectV.setCalibration(self.calibration)
+        if contours:
+            objectV.setLabelImage(labelImage)
             objectV.computeContours()
             objectV.setLabelImage(None)
-            objects.addObject(objectV)
-    return objects
+        return objectV
+
+    def getObjects(self, contours = False, labelImage = None):
+        for index in range(0, self.size()):
+            yield self.getObject(index, contours, labelImage)
+
+### Per-label accumulators filled by a single pass over the label runs and measurement channels
+class ObjectStatistics():
+    def __init__(self, maxLabel, nChannels):
+        size = maxLabel + 1
+        self.maxLabel = maxLabel
+        self.nChannels = nChannels
+        self.count = zeros(size, 'l')
+        self.sumX = zeros(size, 'd')
+        self.sumY = zeros(size, 'd')
+        self.sumZ = zeros(size, 'd')
+        self.lower = [zeros(size, 'i') for axis in range(0, 3)]
+        self.upper = [zeros(size, 'i') for axis in range(0, 3)]
+        for axis in range(0, 3):
+            Arrays.fill(self.lower[axis], Integer.MAX_VALUE)
+            Arrays.fill(self.upper[axis], -1)
+        self.integral = [zeros(size, 'd') for channel in range(0, nChannels)]
+        self.squares = [zeros(size, 'd') for channel in range(0, nChannels)]
+        self.minimum = [zeros(size, 'd') for channel in range(0, nChannels)]
+        self.maximum = [zeros(size, 'd') for channel in range(0, nChannels)]
+        for channel in range(0, nChannels):
+            Arrays.fill(self.minimum[channel], Double.POSITIVE_INFINITY)
+            Arrays.fill(self.maximum[channel], Double.NEGATIVE_INFINITY)
+
+    ### Adds the runs (label, y, x_start, x_end) of plane k. Count, coordinate sums and bounds have closed forms
+    ### per run; channel sums, squares and extremes come from Java side streams over each run's row segment.
+    def accumulate(self, k, runs, sizeX, channels):
+        count = self.count
+        sumX = self.sumX
+        sumY = self.sumY
+        sumZ = self.sumZ
+        (lowerX, lowerY, lowerZ) = self.lower
+        (upperX, upperY, upperZ) = self.upper
+        measured = zip(channels, self.integral, self.squares, self.minimum, self.maximum)
+        for (label, j, start, end) in runs:
+            n = end - start + 1
+            count[label] += n
+            sumX[label] += 0.5 * n * (start + end)
+            sumY[label] += n * j
+            sumZ[label] += n * k
+            if start < lowerX[label]:
+                lowerX[label] = start
+            if end > upperX[label]:
+                upperX[label] = end
+            if j < lowerY[label]:
+                lowerY[label] = j
+            if j > upperY[label]:
+                upperY[label] = j
+            if k < lowerZ[label]:
+                lowerZ[label] = k
+            if k > upperZ[label]:
+                upperZ[label] = k
+            first = j * sizeX + start
+            for (values, squared), integral, squares, minimum, maximum in measured:
+                summary = Arrays.stream(values, first, first + n).summaryStatistics()
+                integral[label] += summary.getSum()
+                squares[label] += Arrays.stream(squared, first, first + n).sum()
+                if summary.getMin() < minimum[label]:
+                    minimum[label] = summary.getMin()
+                if summary.getMax() > maximum[label]:
+                    maximum[label] = summary.getMax()
+
+    def __extend(self, values, size, fill):
+        extended = Arrays.copyOf(values, size)
+        Arrays.fill(extended, len(values), size, fill)
+        return extended
+
+    def grow(self, maxLabel):
+        if maxLabel <= self.maxLabel:
+            return
+        size = maxLabel + 1
+        self.count, self.sumX, self.sumY, self.sumZ = [Arrays.copyOf(values, size) for values in [self.count, self.sumX, self.sumY, self.sumZ]]
+        self.lower = [self.__extend(values, size, Integer.MAX_VALUE) for values in self.lower]
+        self.upper = [self.__extend(values, size, -1) for values in self.upper]
+        self.integral = [Arrays.copyOf(values, size) for values in self.integral]
+        self.squares = [Arrays.copyOf(values, size) for values in self.squares]
+        self.minimum = [self.__extend(values, size, Double.POSITIVE_INFINITY) for values in self.minimum]
+        self.maximum = [self.__extend(values, size, Double.NEGATIVE_INFINITY) for values in self.maximum]
+        self.maxLabel = maxLabel
+
+    def merge(self, other):
+        self.grow(other.maxLabel)
+        sums = [self.count, self.sumX, self.sumY, self.sumZ] + self.integral + self.squares
+        otherSums = [other.count, other.sumX, other.sumY, other.sumZ] + other.integral + other.squares
+        for target, source in zip(sums, otherSums):
+            for label in range(0, other.maxLabel + 1):
+                target[label] += source[label]
+        for axis in range(0, 3):
+            lower = self.lower[axis]
+            upper = self.upper[axis]
+            otherLower = other.lower[axis]
+            otherUpper = other.upper[axis]
+            for label in range(0, other.maxLabel + 1):
+                if otherLower[label] < lower[label]:
+                    lower[label] = otherLower[label]
+                if otherUpper[label] > upper[label]:
+                    upper[label] = otherUpper[label]
+        for channel in range(0, self.nChannels):
+            minimum = self.minimum[channel]
+            maximum = self.maximum[channel]
+            otherMinimum = other.minimum[channel]
+            otherMaximum = other.maximum[channel]
+            for label in range(0, other.maxLabel + 1):
+                if otherMinimum[label] < minimum[label]:
+                    minimum[label] = otherMinimum[label]
+                if otherMaximum[label] > maximum[label]:
+                    maximum[label] = otherMaximum[label]
+
+    ### Scans planes of runs, as (k, runs), together with the float planes of every channel
+    def scan(self, runPlanes, channelPlanes, sizeX, sizeY):
+        for planes in izip(runPlanes, *channelPlanes):
+            (k, runs) = planes[0]
+            channels = []
+            for (z, values) in planes[1:]:
+                squared = FloatProcessor(sizeX, sizeY, values).duplicate()
+                squared.sqr()
+                channels.append((Tools.toDouble(values), Tools.toDouble(squared.getPixels())))
+            self.accumulate(k, runs, sizeX, channels)
+
+    def getLabels(self):
+        return [label for label in range(1, self.maxLabel + 1) if self.count[label]]
+
+    def getCenter(self, label):
+        count = float(self.count[label])
+        return (self.sumX[label] / count, self.sumY[label] / count, self.sumZ[label] / count)
+
+    def getBounds(self, label):
+        return [self.lower[axis][label] for axis in range(0, 3)] + [self.upper[axis][label] for axis in range(0, 3)]
+
+    def getMean(self, label, channel):
+        return self.integral[channel][label] / self.count[label]
+
+    def getVariance(self, label, channel):
+        mean = self.getMean(label, channel)
+        return self.squares[channel][label] / self.count[label] - mean * mean
+
+    def getResults(self, features):
+        results = ResultsTable()
+        results.showRowNumbers(False)
 
-def getMeasurements(objects, image):
-    imageChannels = []
+        for index, label in enumerate(self.getLabels()):
+            results.incrementCounter()
+            results.addValue("Particle", index + 1)
+            if "centroid" in features:
+                cx, cy, cz = self.getCenter(label)
+                results.addValue("cx", cx)
+                results.addValue("cy", cy)
+                results.addValue("cz", cz)
+            if "volume" in features:
+                results.addValue("Volume", float(self.count[label]))
+
+            for channel in range(0, self.nChannels):
+                results.addValue("Integral " + "%i" % channel, self.integral[channel][label])
+                results.addValue("Mean " + "%i" % channel, self.getMean(label, channel))
+
+        return results
+
+### Accumulates the statistics of one z-slab into its own accumulator arrays. Only this slab of the label
+### and channel sources is held in memory; accumulators are sized by the largest label of the slab.
+class StatisticsSlab(Callable):
+    def __init__(self, labelSource, channelSources, zmin, zmax):
+        self.labelSource = labelSource
+        self.channelSources = channelSources
+        self.zmin = zmin
+        self.zmax = zmax
+
+    def call(self):
+        depth = self.zmax - self.zmin
+        (sizeX, sizeY, sizeZ) = sourceDimensions(self.labelSource)
+        runPlanes = [(k, planeRuns(labelProcessor(pixels, sizeX, sizeY))) for (k, pixels) in readPlanes(self.labelSource, self.zmin, self.zmax, depth, False)]
+        maxLabel = max([label for (k, runs) in runPlanes for (label, y, x0, x1) in runs] + [0])
+        channelPlanes = [readPlanes(source, self.zmin, self.zmax, depth, True) for source in self.channelSources]
+        statistics = ObjectStatistics(maxLabel, len(self.channelSources))
+        statistics.scan(runPlanes, channelPlanes, sizeX, sizeY)
+        return statistics
+
+### Slabs are fixed by depth and merged in z order, so results do not depend on the thread count.
+### Sources are ImageStacks or (file, dataset) pairs streamed from HDF5.
+def getStatistics(labelSource, channelSources, ncpus, depth):
+    (sizeX, sizeY, sizeZ) = sourceDimensions(labelSource)
+    pool = Executors.newFixedThreadPool(ncpus)
+    try:
+        futures = []
+        for zmin in range(0, sizeZ, depth):
+            futures.append(pool.submit(StatisticsSlab(labelSource, channelSources, zmin, min(zmin + depth, sizeZ))))
+        statistics = ObjectStatistics(0, len(channelSources))
+        for future in futures:
+            statistics.merge(future.get())
+    finally:
+        pool.shutdown()
+    return statistics
+
+def getChannelStacks(image):
+    channelStacks = []
     splitter = ChannelSplitter()
-    for channel in range (0, image.getNChannels()):
-        channelStack = splitter.getChannel(image, channel + 1)
-        imageChannels.append(ImageHandler.wrap(channelStack))
+    for channel in range (0, image.getNChannels() if image else 0):
+        channelStacks.append(splitter.getChannel(image, channel + 1))
+    return channelStacks
 
-    results = ResultsTable()
-    results.showRowNumbers(False)
+### Label table next to the label image: label, bounding box, voxel count and centroid of every object
+def saveLabelTable(statistics, hdf5, group):
+    labels = statistics.getLabels()
+    centers = [statistics.getCenter(label) for label in labels]
+    bounds = [statistics.getBounds(label) for label in labels]
+    writer = HDF5Factory.open(hdf5)
+    try:
+        writer.int32().writeArray(group + "/label", array(labels, 'i'))
+        writer.int64().writeArray(group + "/count", array([statistics.count[label] for label in labels], 'l'))
+        for axis, name in enumerate(["cx", "cy", "cz"]):
+            writer.float64().writeArray(group + "/" + name, array([center[axis] for center in centers], 'd'))
+        for axis, name in enumerate(["xmin", "ymin", "zmin", "xmax", "ymax", "zmax"]):
+            writer.int32().writeArray(group + "/" + name, array([bound[axis] for bound in bounds], 'i'))
+    finally:
+        writer.close()
+
+### Point cloud as typed, chunked and compressed column datasets, readable column by column
+def savePointCloud(results, hdf5, group):
+    headings = list(results.getHeadings())
+    writer = HDF5Factory.open(hdf5)
+    try:
+        for heading in headings:
+            values = results.getColumnAsDoubles(results.getColumnIndex(heading))
+            path = group + "/" + heading
+            if heading == "Particle":
+                writer.int32().writeArray(path, array([int(value) for value in values], 'i'), HDF5IntStorageFeatures.INT_DEFLATE)
+            elif heading == "Volume":
+                writer.int64().writeArray(path, array([long(value) for value in values], 'l'), HDF5IntStorageFeatures.INT_DEFLATE)
+            else:
+                writer.float64().writeArray(path, values, HDF5FloatStorageFeatures.FLOAT_DEFLATE)
+        writer.string().setArrayAttr(group, "columns", array(headings, String))
+    finally:
+        writer.close()
+
+### Labels of the label table written by saveLabelTable, in the row order of the point cloud
+def readTableLabels(hdf5, group):
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        if not reader.exists(group + "/label"):
+            raise Exception("Label table not found: " + group + " in " + hdf5)
+        return list(reader.int32().readArray(group + "/label"))
+    finally:
+        reader.close()
+
+### Index the next channel would get in a point cloud with "Integral n" / "Mean n" columns
+def nextChannel(results):
+    channel = 0
+    while results.getColumnIndex("Mean " + "%i" % channel) != ResultsTable.COLUMN_NOT_FOUND:
+        channel += 1
+    return channel
+
+### Append the channels of the statistics as new columns, keeping the rows of the existing point cloud. The rows
+### follow the label table, which must list exactly the labels found in the label image.
+def appendMeasurements(results, statistics, tableLabels):
+    labels = statistics.getLabels()
+    if tableLabels != labels:
+        raise Exception("Label table lists " + str(len(tableLabels)) + " labels, label image has " + str(len(labels)) + " and they differ!")
+    if results.size() != len(labels):
+        raise Exception("Point cloud has " + str(results.size()) + " rows, label image has " + str(len(labels)) + " objects!")
+    first = nextChannel(results)
+    for channel in range(0, statistics.nChannels):
+        for row, label in enumerate(labels):
+            results.setValue("Integral " + "%i" % (first + channel), row, statistics.integral[channel][label])
+            results.setValue("Mean " + "%i" % (first + channel), row, statistics.getMean(label, channel))
+    return results
+
+### Surface, sphericity and ellipsoid fit of every object, built from the run-length encoding
+def getShapeMeasurements(runs, contours, labelImage, results):
+    for index, objectV in enumerate(runs.getObjects(contours, labelImage)):
+        if results.size() <= index:
+            results.incrementCounter()
+            results.addValue("Particle", index + 1)
+        results.setValue("Surface", index, objectV.getAreaUnit())
+        results.setValue("Sphericity", index, objectV.getSphericity(True))
+        results.setValue("Elongation", index, objectV.getMainElongation())
+        results.setValue("Flatness", index, objectV.getMedianElongation())
+        results.setValue("Ellipsoid ratio", index, objectV.getRatioEllipsoid())
+    return results
+
+### Uniform grid over calibrated centroids; nearest neighbours are searched in growing shells of cells
+class NeighbourGrid():
+    def __init__(self, points, cellSize):
+        self.points = points
+        self.cellSize = float(cellSize)
+        self.cells = {}
+        for index, point in enumerate(points):
+            self.cells.setdefault(self.__cell(point), []).append(index)
+        self.extent = max([max([abs(c) for c in cell]) for cell in self.cells] + [0]) * 2 + 1
+
+    def __cell(self, point):
+        return tuple([int(math.floor(c / self.cellSize)) for c in point])
 
-    for index, objectV in enumerate(objects.getObjectsList()):
-        results.incrementCounter()
-        results.addValue("Particle", index + 1)
-        results.addValue("cx", objectV.getCenterX())
-        results.addValue("cy", objectV.getCenterY())
-        results.addValue("cz", objectV.getCenterZ())
-        results.addValue("Volume", objectV.getVolumePixels())
+    def __distance(self, a, b):
+        return math.sqrt(sum([(a[axis] - b[axis]) ** 2 for axis in range(0, 3)]))
 
-        for channel, channelImage in enumerate(imageChannels):
-            results.addValue("Integral " + "%i" % channel,  objectV.getIntegratedDensity(channelImage))
-            results.addValue("Mean " + "%i" % channel, objectV.getPixMeanValue(channelImage))
+    def __shell(self, cell, ring):
+        (ci, cj, ck) = cell
+        for di in range(-ring, ring + 1):
+            for dj in range(-ring, ring + 1):
+                for dk in range(-ring, ring + 1):
+                    if max(abs(di), abs(dj), abs(dk)) == ring:
+                        for index in self.cells.get((ci + di, cj + dj, ck + dk), []):
+                            yield index
 
+    ### Points outside the shells searched so far are at least ring * cellSize away
+    def nearest(self, index):
+        point = self.points[index]
+        cell = self.__cell(point)
+        best = float('nan')
+        for ring in range(0, self.extent + 1):
+            for other in self.__shell(cell, ring):
+                if other != index:
+                    distance = self.__distance(point, self.points[other])
+                    if math.isnan(best) or distance < best:
+                        best = distance
+            if best <= ring * self.cellSize:
+                break
+        return best
+
+    def count(self, index, radius):
+        point = self.points[index]
+        cell = self.__cell(point)
+        neighbours = 0
+        for ring in range(0, int(math.ceil(radius / self.cellSize)) + 1):
+            for other in self.__shell(cell, ring):
+                if other != index and self.__distance(point, self.points[other]) <= radius:
+                    neighbours += 1
+        return neighbours
+
+### Nearest neighbour distance and neighbour counts within the given radii, in calibrated units
+def getNeighbourMeasurements(statistics, calibration, radii, results):
+    scale = [calibration.pixelWidth, calibration.pixelHeight, calibration.pixelDepth]
+    points = []
+    for label in statistics.getLabels():
+        center = statistics.getCenter(label)
+        points.append([center[axis] * scale[axis] for axis in range(0, 3)])
+    if radii:
+        cellSize = max(radii)
+    else:
+        volume = 1.0
+        for axis in range(0, 3):
+            volume *= max([point[axis] for point in points] + [1.0])
+        cellSize = (volume / max(len(points), 1)) ** (1.0 / 3.0)
+    grid = NeighbourGrid(points, cellSize)
+    for index in range(0, len(points)):
+        results.setValue("NN distance", index, grid.nearest(index))
+        for radius in radii:
+            results.setValue("Neighbours " + "%g" % radius, index, grid.count(index, radius))
     return results
 
-def dog(image, sigmaX, sigmaY, sigmaZ, div):
+### Intermediate data needed by each feature of a measurement profile, on top of the label scan
+### that always runs for the label table
+profileSteps = {
+    "centroid": [],
+    "volume": [],
+    "intensity": ["channels"],
+    "neighbours": [],
+    "shape": ["runs", "objects", "contours"]
+}
+
+def planMeasurements(profile):
+    features = [feature.strip() for feature in profile.split(",") if feature.strip()]
+    steps = set()
+    for feature in features:
+        if feature not in profileSteps:
+            raise Exception("Unknown measurement feature: " + feature)
+        steps.update(profileSteps[feature])
+    return (features, steps)
+
+### Young & van Vliet (1995) recursive Gaussian coefficients (B, b1, b2, b3), normalised by b0
+def recursiveCoefficients(sigma):
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * math.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+    b1 = 2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3
+    b2 = -(1.4281 * q ** 2 + 1.26661 * q ** 3)
+    b3 = 0.422205 * q ** 3
+    return (1 - (b1 + b2 + b3) / b0, b1 / b0, b2 / b0, b3 / b0)
+
+### Forward and backward third order recursion across a sequence of equally sized float arrays, in place. Every
+### step is a whole array operation on the Java side; each direction starts from its edge array.
+def recursiveSlices(slices, coefficients):
+    (B, b1, b2, b3) = coefficients
+    size = len(slices[0])
+    slices = [FloatProcessor(size, 1, values) for values in slices]
+    term = FloatProcessor(size, 1)
+    for order in [range(0, len(slices)), range(len(slices) - 1, -1, -1)]:
+        edge = slices[order[0]].duplicate()
+        history = [edge, edge, edge]
+        for t in order:
+            current = slices[t]
+            current.multiply(B)
+            for weight, previous in zip([b1, b2, b3], history):
+                term.insert(previous, 0, 0)
+                term.multiply(weight)
+                current.copyBits(term, 0, 0, Blitter.ADD)
+            history = [current, history[0], history[1]]
+
+### Filters one axis within a range of planes (x, y) or rows (z), in place. Lines along y are filtered by recursing
+### over rows gathered across the planes; planes are turned right first to filter x the same way.
+class RecursivePass(Callable):
+    def __init__(self, planes, sizeX, sizeY, axis, coefficients, first, last):
+        self.planes = planes
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.axis = axis
+        self.coefficients = coefficients
+        self.first = first
+        self.last = last
+
+    def call(self):
+        sizeX = self.sizeX
+        sizeY = self.sizeY
+        if self.axis == 2:
+            (start, end) = (self.first * sizeX, self.last * sizeX)
+            slices = [Arrays.copyOfRange(plane, start, end) for plane in self.planes]
+            recursiveSlices(slices, self.coefficients)
+            for plane, values in zip(self.planes, slices):
+                System.arraycopy(values, 0, plane, start, end - start)
+            return self
+        planes = self.planes[self.first:self.last]
+        if self.axis == 0:
+            turned = [FloatProcessor(sizeX, sizeY, plane).rotateRight() for plane in planes]
+            lines = [ip.getPixels() for ip in turned]
+            (width, height) = (sizeY, sizeX)
+        else:
+            lines = planes
+            (width, height) = (sizeX, sizeY)
+        rows = [zeros(width * len(lines), 'f') for j in range(0, height)]
+        for k, plane in enumerate(lines):
+            for j in range(0, height):
+                System.arraycopy(plane, j * width, rows[j], k * width, width)
+        recursiveSlices(rows, self.coefficients)
+        for k, plane in enumerate(lines):
+            for j in range(0, height):
+                System.arraycopy(rows[j], k * width, plane, j * width, width)
+        if self.axis == 0:
+            for plane, ip in zip(planes, turned):
+                System.arraycopy(ip.rotateLeft().getPixels(), 0, plane, 0, sizeX * sizeY)
+        return self
+
+### Gaussian blur with constant cost per voxel for any sigma, applied in place to float planes
+def gaussRecursive(planes, sizeX, sizeY, sigmas, ncpus):
+    pool = Executors.newFixedThreadPool(ncpus)
+    try:
+        for axis, sigma in enumerate(sigmas):
+            if sigma < 0.5 or (axis == 2 and len(planes) < 2):
+                continue
+            coefficients = recursiveCoefficients(sigma)
+            count = len(planes) if axis < 2 else sizeY
+            step = max(1, count / (4 * ncpus))
+            futures = []
+            for first in range(0, count, step):
+                futures.append(pool.submit(RecursivePass(planes, sizeX, sizeY, axis, coefficients, first, min(first + step, count))))
+            for future in futures:
+                future.get()
+    finally:
+        pool.shutdown()
+    return planes
+
+def floatStack(imp):
+    stack = imp.getImageStack()
+    result = ImageStack(stack.getWidth(), stack.getHeight())
+    for k in range(0, stack.getSize()):
+        ip = stack.getProcessor(k + 1)
+        result.addSlice(ip.duplicate() if ip.getBitDepth() == 32 else ip.convertToFloat())
+    return result
+
+def dogRecursive(image, sigmaA, sigmaB, ncpus):
+    imp = convert.convert(image, ImagePlus)
+    stackA = floatStack(imp)
+    stackB = floatStack(imp)
+    sizeX = stackA.getWidth()
+    sizeY = stackA.getHeight()
+    gaussRecursive([stackA.getPixels(k + 1) for k in range(0, stackA.getSize())], sizeX, sizeY, sigmaA, ncpus)
+    gaussRecursive([stackB.getPixels(k + 1) for k in range(0, stackB.getSize())], sizeX, sizeY, sigmaB, ncpus)
+    for k in range(0, stackB.getSize()):
+        stackB.getProcessor(k + 1).copyBits(stackA.getProcessor(k + 1), 0, 0, Blitter.SUBTRACT)
+    return ImageJFunctions.wrapFloat(ImagePlus("dog", stackB))
+
+### Largest downsampling factor for a Gaussian of the given sigma that keeps both the aliasing of its
+### spectrum and the linear interpolation error of the upsampled result below tol (relative amplitude)
+def pyramidFactor(sigma, tol):
+    if tol <= 0 or tol >= 1:
+        return 1
+    aliasing = math.pi * sigma / math.sqrt(2 * math.log(1 / tol))
+    interpolation = sigma * math.sqrt(8 * tol)
+    return max(1, int(min(aliasing, interpolation)))
+
+### Gaussian blur of a float image with Gauss3 on a pool of the given size, mirrored at the borders like ops gauss
+def gaussThreads(image32, sigmas, threads):
+    result = ArrayImgFactory(FloatType()).create(image32)
+    pool = Executors.newFixedThreadPool(threads)
+    try:
+        Gauss3.gauss(array(sigmas, 'd'), Views.extendMirrorSingle(image32), result, pool)
+    finally:
+        pool.shutdown()
+    return result
+
+### Gaussian blur computed on a block averaged copy and linearly interpolated back to full resolution
+def gaussPyramid(imp, sigmas, tol, threads):
+    size = [imp.getWidth(), imp.getHeight(), imp.getNSlices()]
+    factors = [min(pyramidFactor(s, tol), n) for s, n in zip(sigmas, size)]
+    if factors == [1, 1, 1]:
+        return gaussThreads(ImageJFunctions.wrapFloat(imp), sigmas, threads)
+    small = Binner().shrink(imp, factors[0], factors[1], factors[2], Binner.AVERAGE)
+    residual = [math.sqrt(max(0.0, s * s - (f * f - 1) / 12.0)) / f for s, f in zip(sigmas, factors)]
+    blurred = gaussThreads(ImageJFunctions.wrapFloat(small), residual, threads)
+    small.close()
+    (fx, fy, fz) = [float(f) for f in factors]
+    transform = AffineTransform3D()
+    transform.set(array([fx, 0, 0, (fx - 1) / 2, 0, fy, 0, (fy - 1) / 2, 0, 0, fz, (fz - 1) / 2], 'd'))
+    interpolated = Views.interpolate(Views.extendBorder(blurred), NLinearInterpolatorFactory())
+    upsampled = Views.interval(Views.raster(RealViews.affine(interpolated, transform)), [0, 0, 0], [n - 1 for n in size])
+    return ops.copy().rai(upsampled)
+
+def dogPyramid(image, sigmaA, sigmaB, tol, threads):
+    imp = ImagePlus("dog", floatStack(convert.convert(image, ImagePlus)))
+    blurA = gaussPyramid(imp, sigmaA, tol, threads)
+    blurB = gaussPyramid(imp, sigmaB, tol, threads)
+    return ops.eval("fine - coarse", {"fine": blurB, "coarse": blurA})
+
+### Storage scale of an int16 DoG whose values lie within +-extent, mapped onto 32767 steps. int16 is a storage
+### format only: the extent is known once the DoG is finished, so the working DoG stays float32 and the peaks are
+### found on it. A scale fixed before filtering could only come from the intensity range, far too coarse a step.
+def dogScale(extent):
+    return max(extent, 1e-12) / 32767
+
+### Chunked, deflate compressed DoG dataset: float32, or int16 with DoG = value * scale when a scale is given
+def createDogDataset(writer, dataset, size, chunk, calibration, scale):
+    (sizeX, sizeY, sizeZ) = size
+    (chunkX, chunkY, chunkZ) = chunk
+    if writer.exists(dataset):
+        writer.delete(dataset)
+    dimensions = array([sizeZ, sizeY, sizeX], 'l')
+    blocks = array([chunkZ, chunkY, chunkX], 'i')
+    if scale is None:
+        writer.float32().createMDArray(dataset, dimensions, blocks, HDF5FloatStorageFeatures.FLOAT_DEFLATE)
+    else:
+        writer.int16().createMDArray(dataset, dimensions, blocks, HDF5IntStorageFeatures.INT_DEFLATE)
+        writer.float64().setAttr(dataset, "scale", scale)
+    writer.float32().setArrayAttr(dataset, "element_size_um", array([calibration.pixelDepth, calibration.pixelHeight, calibration.pixelWidth], 'f'))
+
+### Writes a zyx block of float DoG values, as float32 or rounded to the nearest int16 step of the scale. The
+### offset of 32768 makes the values positive, so the rounding conversion to 16-bit rounds half up like Math.round.
+def writeDogBlock(writer, dataset, flat, size, offset, scale):
+    (w, h, d) = size
+    (x, y, z) = offset
+    dimensions = array([d, h, w], 'i')
+    if scale is None:
+        writer.float32().writeMDArrayBlockWithOffset(dataset, MDFloatArray(flat, dimensions), array([z, y, x], 'l'))
+        return
+    ip = FloatProcessor(w, h * d, flat)
+    ip.multiply(1.0 / scale)
+    ip.add(32768)
+    steps = ip.convertToShortProcessor(False)
+    steps.xor(0x8000)
+    writer.int16().writeMDArrayBlockWithOffset(dataset, MDShortArray(steps.getPixels(), dimensions), array([z, y, x], 'l'))
+
+### Saves the DoG planes of an ImageStack or HDF5 source plane by plane
+def saveDog(source, hdf5, dataset, calibration, scale):
+    (sizeX, sizeY, sizeZ) = sourceDimensions(source)
+    writer = HDF5Factory.open(hdf5)
+    try:
+        createDogDataset(writer, dataset, (sizeX, sizeY, sizeZ), (min(256, sizeX), min(256, sizeY), min(slab, sizeZ)), calibration, scale)
+        for (k, pixels) in readPlanes(source, 0, sizeZ, slab, True):
+            plane = Arrays.copyOf(pixels, sizeX * sizeY)
+            writeDogBlock(writer, dataset, plane, (sizeX, sizeY, 1), (0, 0, k), scale)
+    finally:
+        writer.close()
+
+### DoG of one tile: the core block at (x, y, z) of size (w, h, d) is filtered together with a halo of about
+### 3 sigma and written straight into the output float32 dataset. Writes share one HDF5 writer behind a lock.
+### The tile keeps the largest |DoG| of its core as extent.
+class DogTile(Callable):
+    def __init__(self, stack, writer, lock, dataset, core, halo, sigmas, div, mode):
+        self.stack = stack
+        self.writer = writer
+        self.lock = lock
+        self.dataset = dataset
+        self.core = core
+        self.halo = halo
+        self.sigmas = sigmas
+        self.div = div
+        self.mode = mode
+        self.extent = 0.0
+
+    def call(self):
+        (x, y, z, w, h, d) = self.core
+        (hx, hy, hz) = self.halo
+        x0 = max(0, x - hx)
+        y0 = max(0, y - hy)
+        z0 = max(0, z - hz)
+        x1 = min(self.stack.getWidth(), x + w + hx)
+        y1 = min(self.stack.getHeight(), y + h + hy)
+        z1 = min(self.stack.getSize(), z + d + hz)
+        block = ImagePlus("tile", floatStack(ImagePlus("tile", self.stack.crop(x0, y0, z0, x1 - x0, y1 - y0, z1 - z0))))
+        (sigmaX, sigmaY, sigmaZ) = self.sigmas
+        result = dog(convert.convert(block, Dataset), sigmaX, sigmaY, sigmaZ, self.div, self.mode, 1)
+        result = convert.convert(result, ImagePlus).getImageStack().crop(x - x0, y - y0, z - z0, w, h, d)
+        flat = zeros(w * h * d, 'f')
+        for k in range(0, d):
+            System.arraycopy(result.getProcessor(k + 1).convertToFloat().getPixels(), 0, flat, k * w * h, w * h)
+        stats = FloatProcessor(w, h * d, flat).getStatistics()
+        self.extent = max(abs(stats.min), abs(stats.max))
+        self.lock.lock()
+        try:
+            writeDogBlock(self.writer, self.dataset, flat, (w, h, d), (x, y, z), None)
+        finally:
+            self.lock.unlock()
+        return self
+
+### DoG of a whole stack computed tile by tile on a thread pool into a chunked float32 dataset. Each tile is
+### filtered single threaded, so the pool alone sets the thread count. Peak memory is set by the tile size and
+### the number of tiles in flight, not by the stack. Returns the largest |DoG|, the extent for dogScale.
+def dogTiled(imp, hdf5, dataset, sigmaX, sigmaY, sigmaZ, div, mode, tile, ncpus):
+    stack = imp.getImageStack()
+    (sizeX, sizeY, sizeZ) = (stack.getWidth(), stack.getHeight(), stack.getSize())
+    halo = [int(math.ceil(3 * s)) for s in (sigmaX, sigmaY, sigmaZ)]
+    calibration = imp.getCalibration()
+    writer = HDF5Factory.open(hdf5)
+    try:
+        chunk = (min(tile, sizeX), min(tile, sizeY), min(slab, tile, sizeZ))
+        createDogDataset(writer, dataset, (sizeX, sizeY, sizeZ), chunk, calibration, None)
+        lock = ReentrantLock()
+        pool = Executors.newFixedThreadPool(ncpus)
+        try:
+            futures = []
+            for z in range(0, sizeZ, tile):
+                for y in range(0, sizeY, tile):
+                    for x in range(0, sizeX, tile):
+                        core = (x, y, z, min(tile, sizeX - x), min(tile, sizeY - y), min(tile, sizeZ - z))
+                        futures.append(pool.submit(DogTile(stack, writer, lock, dataset, core, halo, (sigmaX, sigmaY, sigmaZ), div, mode)))
+            extent = max([future.get().extent for future in futures] + [0.0])
+        finally:
+            pool.shutdown()
+    finally:
+        writer.close()
+    return extent
+
+### Mirror padding of at least 3 sigma per side, grown to sizes the FFT handles fast: (padded dimensions, interval)
+def fftPadding(image, sigmas):
+    padded = array([image.dimension(d) + 2 * int(math.ceil(3 * sigmas[d])) for d in range(0, 3)], 'l')
+    paddedDims = zeros(3, 'l')
+    fftDims = zeros(3, 'l')
+    FFTMethods.dimensionsRealToComplexFast(FinalDimensions(padded), paddedDims, fftDims)
+    return paddedDims, FFTMethods.paddingIntervalCentered(image, FinalDimensions(paddedDims))
+
+### Rough operation counts of the separable spatial DoG and of the FFT DoG, used to pick one in auto mode
+def dogCosts(image, sigmaA, sigmaB):
+    volume = float(Intervals.numElements(image))
+    taps = sum([2 * math.ceil(3 * s) + 1 for s in sigmaA + sigmaB])
+    (paddedDims, interval) = fftPadding(image, sigmaA)
+    padded = float(paddedDims[0] * paddedDims[1] * paddedDims[2])
+    return volume * taps, padded * (5 * math.log(padded, 2) + 10)
+
+### Gaussian transfer function along one axis of n samples, for the first m frequencies (folded above n / 2)
+def gaussTransfer(sigma, n, m):
+    values = []
+    for k in range(0, m):
+        w = 2 * math.pi * (k if k <= n / 2 else k - n) / n
+        values.append(math.exp(-0.5 * sigma * sigma * w * w))
+    return values
+
+### Multiplies an interleaved (re, im) ArrayImg spectrum in place by exp(-|sigmaB w|^2 / 2) - exp(-|sigmaA w|^2 / 2).
+### Both terms are separable, so the transfer function of each z plane is built from two xy base planes.
+def multiplyDogTransfer(spectrum, paddedDims, sigmaA, sigmaB):
+    (sizeX, sizeY, sizeZ) = [int(spectrum.dimension(d)) for d in range(0, 3)]
+    transfers = []
+    for sigmas in (sigmaA, sigmaB):
+        (gx, gy, gz) = [gaussTransfer(sigmas[d], int(paddedDims[d]), int(spectrum.dimension(d))) for d in range(0, 3)]
+        base = zeros(2 * sizeX * sizeY, 'f')
+        for j in range(0, sizeY):
+            for i in range(0, sizeX):
+                base[2 * (j * sizeX + i)] = base[2 * (j * sizeX + i) + 1] = gx[i] * gy[j]
+        transfers.append((FloatProcessor(2 * sizeX, sizeY, base), gz))
+    ((baseA, gzA), (baseB, gzB)) = transfers
+    storage = spectrum.update(None).getCurrentStorageArray()
+    planeSize = 2 * sizeX * sizeY
+    for k in range(0, sizeZ):
+        transfer = baseB.duplicate()
+        transfer.multiply(gzB[k])
+        coarse = baseA.duplicate()
+        coarse.multiply(gzA[k])
+        transfer.copyBits(coarse, 0, 0, Blitter.SUBTRACT)
+        plane = FloatProcessor(2 * sizeX, sizeY, Arrays.copyOfRange(storage, k * planeSize, (k + 1) * planeSize))
+        plane.copyBits(transfer, 0, 0, Blitter.MULTIPLY)
+        System.arraycopy(plane.getPixels(), 0, storage, k * planeSize, planeSize)
+
+### DoG through the frequency domain: one forward FFT of the mirror padded image, a product with the
+### analytic DoG transfer function and one inverse FFT cropped back to the image
+def dogFFT(image, sigmaA, sigmaB, ncpus):
+    image32 = ops.convert().float32(image)
+    (paddedDims, interval) = fftPadding(image32, sigmaA)
+    pool = Executors.newFixedThreadPool(ncpus)
+    try:
+        spectrum = FFT.realToComplex(Views.interval(Views.extendMirrorSingle(image32), interval), ArrayImgFactory(ComplexFloatType()), pool)
+        multiplyDogTransfer(spectrum, paddedDims, sigmaA, sigmaB)
+        result = ArrayImgFactory(FloatType()).create(image32)
+        FFT.complexToRealUnpad(spectrum, result, pool)
+    finally:
+        pool.shutdown()
+    return result
+
+### DoG with the filters of the given mode running on the given number of threads
+def dog(image, sigmaX, sigmaY, sigmaZ, div, mode = "exact", threads = 1):
     sigmaA = [sigmaX, sigmaY, sigmaZ]
     sigmaB = [sigmaX / div, sigmaY / div, sigmaZ / div]
+    if mode == "auto":
+        (spatial, fft) = dogCosts(image, sigmaA, sigmaB)
+        mode = "fft" if fft < spatial else "exact"
+        print "DoG mode auto: " + mode
+    if mode == "fft":
+        return dogFFT(image, sigmaA, sigmaB, threads)
+    if mode == "recursive":
+        return dogRecursive(image, sigmaA, sigmaB, threads)
+    if mode == "pyramid":
+        return dogPyramid(image, sigmaA, sigmaB, dogtol, threads)
     image32 = ops.convert().float32(image)
-    dogFormula = "gauss(image, " + str(sigmaB) + ") - gauss(image, " + str(sigmaA) + ")"
-    result = ops.eval(dogFormula, {"image": image32})
-    return result
+    fine = gaussThreads(image32, sigmaB, threads)
+    coarse = gaussThreads(image32, sigmaA, threads)
+    return ops.eval("fine - coarse", {"fine": fine, "coarse": coarse})
 
-def threshold(image):
-    result = ops.threshold().apply(image, FloatType(0))
-    return result
+### Per axis pixel sigmas and radii (x, y, z), converted from calibrated units with the voxel size if asked
+def pixelScales(calibration, sigma, radius, calibrated):
+    if not calibrated:
+        return [float(sigma)] * 3, [float(radius)] * 3
+    size = [calibration.pixelWidth, calibration.pixelHeight, calibration.pixelDepth]
+    return [sigma / s for s in size], [radius / s for s in size]
 
-def maxima(image, radius, cutoff):
-    imp = convert.convert(ops.copy().img(image), ImagePlus)
-    filters = FastFilters3D()
-    oimp = ImagePlus("maxima", filters.filterImageStack(imp.getImageStack(), FastFilters3D.MAXLOCAL, radius, radius, radius, Runtime.getRuntime().availableProcessors(), True))
-    imp.close()
-    maxima = ops.copy().img(convert.convert(oimp, Dataset))
-    oimp.close()
-    return ops.threshold().apply(maxima, FloatType(cutoff))
+### Records the per axis sigmas (zyx, as element_size_um) and the ratio used for a saved DoG
+def saveDogAttributes(hdf5, dataset, sigmas, div):
+    writer = HDF5Factory.open(hdf5)
+    try:
+        writer.float64().setArrayAttr(dataset, "sigma", array([sigmas[2], sigmas[1], sigmas[0]], 'd'))
+        writer.float64().setAttr(dataset, "sigma_ratio", div)
+    finally:
+        writer.close()
+
+### Rows of the ellipsoid with radii (rx, ry, rz) grouped by half width: {w: [(dz, dy), ...]}
+def ballRows(radii):
+    (rx, ry, rz) = radii
+    rows = {}
+    for dz in range(-int(rz), int(rz) + 1):
+        for dy in range(-int(ry), int(ry) + 1):
+            remainder = 1.0
+            if dy:
+                remainder -= (float(dy) / ry) ** 2
+            if dz:
+                remainder -= (float(dz) / rz) ** 2
+            if remainder >= 0:
+                w = int(rx * math.sqrt(remainder) + 1e-9)
+                rows.setdefault(w, []).append((dz, dy))
+    return rows
+
+### Running maxima over the ellipsoid with the given radii along a stream of n float planes. Each added plane
+### is max filtered along x for growing half widths and shifted into the maxima of the output planes it
+### reaches; add() returns the output planes completed so far, in order.
+class EllipsoidMax():
+    def __init__(self, radii, sizeX, sizeY, n):
+        self.rows = ballRows(radii)
+        self.rx = int(radii[0])
+        self.depth = int(radii[2])
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.n = n
+        self.ball = {}
+        self.count = 0
+        self.emitted = 0
+
+    def add(self, plane):
+        k = self.count
+        self.count += 1
+        for z in range(k, min(k + self.depth + 1, self.n)):
+            if z not in self.ball:
+                self.ball[z] = FloatProcessor(self.sizeX, self.sizeY)
+                self.ball[z].setValue(-Float.MAX_VALUE)
+                self.ball[z].fill()
+        line = plane.duplicate()
+        for w in range(0, self.rx + 1):
+            if w > 0:
+                line.copyBits(plane, w, 0, Blitter.MAX)
+                line.copyBits(plane, -w, 0, Blitter.MAX)
+            for (dz, dy) in self.rows.get(w, []):
+                if k - dz in self.ball:
+                    self.ball[k - dz].copyBits(line, 0, dy, Blitter.MAX)
+        last = self.n - 1 if k == self.n - 1 else k - self.depth
+        outputs = []
+        while self.emitted <= last:
+            outputs.append(self.ball.pop(self.emitted))
+            self.emitted += 1
+        return outputs
+
+### van Herk / Gil-Werman running maximum over windows of 2 * r + 1 slices, clipped at both ends, along a
+### stream of n equally sized float processors. Prefix maxima (g) run within blocks of 2 * r + 1 slices and
+### suffix maxima (h) are filled in when a block is complete; each window is max(h[a], g[b]), so every slice
+### costs a fixed number of Blitter.MAX operations for any r. add() returns the completed maxima, in order.
+class RunningMax():
+    def __init__(self, r, n):
+        self.r = r
+        self.k = 2 * r + 1
+        self.n = n
+        self.g = None
+        self.h = {}
+        self.block = []
+        self.count = 0
+        self.emitted = 0
+
+    def add(self, ip):
+        j = self.count
+        self.count += 1
+        if j % self.k == 0:
+            self.g = ip.duplicate()
+        else:
+            self.g.copyBits(ip, 0, 0, Blitter.MAX)
+        self.block.append(ip)
+        if j % self.k == self.k - 1 or j == self.n - 1:
+            start = j - len(self.block) + 1
+            suffix = self.block[-1].duplicate()
+            self.h[j] = suffix
+            for t in range(len(self.block) - 2, -1, -1):
+                suffix = suffix.duplicate()
+                suffix.copyBits(self.block[t], 0, 0, Blitter.MAX)
+                self.h[start + t] = suffix
+            self.block = []
+        outputs = []
+        while self.emitted < self.n and (self.emitted + self.r <= j or j == self.n - 1):
+            a = self.emitted - self.r
+            b = min(self.emitted + self.r, self.n - 1)
+            if a <= 0:
+                result = self.g.duplicate()
+            elif a / self.k == b / self.k:
+                result = self.h.pop(a)
+            else:
+                result = self.h.pop(a)
+                result.copyBits(self.g, 0, 0, Blitter.MAX)
+            outputs.append(result)
+            self.emitted += 1
+        for a in [a for a in self.h if a < self.emitted - self.r]:
+            del self.h[a]
+        return outputs
+
+### Running maximum along y over windows of 2 * r + 1 rows of a float processor
+def rowMax(ip, r):
+    if r <= 0:
+        return ip
+    (w, h) = (ip.getWidth(), ip.getHeight())
+    pixels = ip.getPixels()
+    result = zeros(w * h, 'f')
+    running = RunningMax(r, h)
+    y = 0
+    for j in range(0, h):
+        for row in running.add(FloatProcessor(w, 1, Arrays.copyOfRange(pixels, j * w, (j + 1) * w))):
+            System.arraycopy(row.getPixels(), 0, result, y * w, w)
+            y += 1
+    return FloatProcessor(w, h, result)
+
+### Running maxima over the union of boxes with half sizes (rx, ry, rz), each separable into x and y passes per
+### plane and a z pass over the stream, all of them van Herk / Gil-Werman running maxima
+class BoxMax():
+    def __init__(self, boxes, n):
+        self.boxes = boxes
+        self.running = [RunningMax(rz, n) for (rx, ry, rz) in boxes]
+        self.queues = [[] for box in boxes]
+
+    def add(self, plane):
+        for (rx, ry, rz), running, queue in izip(self.boxes, self.running, self.queues):
+            filtered = plane
+            if rx > 0:
+                filtered = rowMax(filtered.rotateLeft(), rx).rotateRight()
+            filtered = rowMax(filtered, ry)
+            queue.extend(running.add(filtered))
+        outputs = []
+        while all(self.queues):
+            result = self.queues[0].pop(0)
+            for queue in self.queues[1:]:
+                result.copyBits(queue.pop(0), 0, 0, Blitter.MAX)
+            outputs.append(result)
+        return outputs
+
+### Boxes of a local maxima neighbourhood: a single box with the given radii, or a union of four boxes
+### inscribed in the ellipsoid (a cube and three plates) as its separable approximation
+def neighbourhoodBoxes(radii, neighbourhood):
+    if neighbourhood == "box":
+        factors = [(1.0, 1.0, 1.0)]
+    else:
+        factors = [(0.577, 0.577, 0.577), (0.8, 0.42, 0.42), (0.42, 0.8, 0.42), (0.42, 0.42, 0.8)]
+    return [tuple([int(f * r + 1e-9) for f, r in zip(factor, radii)]) for factor in factors]
+
+### Binary 0/1 mask of a float plane for lower <= value <= upper
+def planeMask(ip, lower, upper):
+    ip.setThreshold(lower, upper, ImageProcessor.NO_LUT_UPDATE)
+    mask = ip.createMask()
+    ip.resetThreshold()
+    mask.multiply(1.0 / 255)
+    return mask
+
+### Local maxima of a volume as a compact list of voxel coordinates and DoG values
+class PeakList():
+    def __init__(self, sizeX, sizeY, sizeZ):
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.sizeZ = sizeZ
+        self.x = []
+        self.y = []
+        self.z = []
+        self.value = []
+
+    def size(self):
+        return len(self.x)
+
+    def add(self, x, y, z, value):
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+        self.value.append(value)
+
+    ### Adds the set pixels of a 0/1 seed plane with their values in the DoG plane
+    def addPlane(self, k, seeds, plane, scale):
+        seeds.setThreshold(1, 255, ImageProcessor.NO_LUT_UPDATE)
+        roi = ThresholdToSelection().convert(seeds)
+        seeds.resetThreshold()
+        if roi is None:
+            return
+        for point in roi.getContainedPoints():
+            self.add(point.x, point.y, k, plane.getf(point.x, point.y) * scale)
+
+    ### Dense 0/255 seed image like the thresholded maxima, above the seeds threshold of Watershed3D; only built for it
+    def toImage(self):
+        stack = ImageStack(self.sizeX, self.sizeY)
+        planes = [ByteProcessor(self.sizeX, self.sizeY) for k in range(0, self.sizeZ)]
+        for plane in planes:
+            stack.addSlice(plane)
+        for (x, y, z) in izip(self.x, self.y, self.z):
+            planes[z].set(x, y, 255)
+        return ImagePlus("maxima", stack)
+
+    def save(self, hdf5, group):
+        writer = HDF5Factory.open(hdf5)
+        try:
+            writer.int32().writeArray(group + "/x", array(self.x, 'i'))
+            writer.int32().writeArray(group + "/y", array(self.y, 'i'))
+            writer.int32().writeArray(group + "/z", array(self.z, 'i'))
+            writer.float32().writeArray(group + "/value", array(self.value, 'f'))
+        finally:
+            writer.close()
+
+    @classmethod
+    def load(cls, hdf5, group, sizeX, sizeY, sizeZ):
+        peaks = cls(sizeX, sizeY, sizeZ)
+        reader = HDF5Factory.openForReading(hdf5)
+        try:
+            peaks.x = list(reader.int32().readArray(group + "/x"))
+            peaks.y = list(reader.int32().readArray(group + "/y"))
+            peaks.z = list(reader.int32().readArray(group + "/z"))
+            peaks.value = list(reader.float32().readArray(group + "/value"))
+        finally:
+            reader.close()
+        return peaks
+
+    ### Peaks with a value above the cutoff
+    def select(self, cutoff):
+        peaks = PeakList(self.sizeX, self.sizeY, self.sizeZ)
+        for (x, y, z, value) in izip(self.x, self.y, self.z, self.value):
+            if value > cutoff:
+                peaks.add(x, y, z, value)
+        return peaks
+
+### Every parameter the mask and the candidate peaks depend on, to tell whether a peak cache can be reused.
+### The cutoff the candidates were selected with is kept apart, as any higher cutoff can reuse them.
+def peakCacheKey():
+    return ";".join(["%s=%s" % item for item in [("inputfile", inhdf5), ("dsegm", dsegm), ("model", str(model)),
+        ("pmapidx", pmapidx), ("sigma", sigma), ("div", div), ("dogmode", dogmode), ("dogtol", dogtol),
+        ("dogtile", tiling), ("dogstorage", dogstorage), ("calibrated", calibrated), ("radius", radius),
+        ("neighbourhood", neighbourhood), ("nslabs", nslabs), ("slabindex", slabindex), ("slaboverlap", slaboverlap)]])
+
+### The queue watershed also needs the DoG levels, so a cache without them, or quantized into a different
+### number of levels, is not valid for it
+def peakCacheValid(cache, key, cutoff, levels):
+    if not os.path.isfile(cache):
+        return False
+    reader = HDF5Factory.openForReading(cache)
+    try:
+        if not reader.exists("/watershed/peaks/value"):
+            return False
+        if levels and not (reader.exists("/watershed/levels") and reader.int32().getAttr("/watershed/levels", "levels") == levels):
+            return False
+        if not reader.object().hasAttribute("/", "parameters") or not reader.object().hasAttribute("/", "cutoff"):
+            return False
+        if reader.string().getAttr("/", "parameters") != key:
+            return False
+        return cutoff >= reader.float64().getAttr("/", "cutoff")
+    finally:
+        reader.close()
+
+### Mask and all candidate peaks above candidateCutoff of one DoG and maxima run, so that any cutoff from
+### candidateCutoff up can go straight to the watershed. The DoG levels of the queue watershed are kept when given.
+def savePeakCache(cache, mask, candidates, key, candidateCutoff, height, levels):
+    method = "Scriptable save HDF5 (append)..."
+    options = "save=[" +  cache + "] dsetnametemplate=/watershed/mask formatchannel=%d compressionlevel=0"
+    IJ.run(mask, method, options)
+    candidates.save(cache, "/watershed/peaks")
+    writer = HDF5Factory.open(cache)
+    try:
+        writer.string().setAttr("/", "parameters", key)
+        writer.float64().setAttr("/", "cutoff", candidateCutoff)
+        if height is not None:
+            stack = mask.getImageStack()
+            dimensions = array([stack.getSize(), stack.getHeight(), stack.getWidth()], 'i')
+            writer.int16().writeMDArray("/watershed/levels", MDShortArray(height, dimensions), HDF5IntStorageFeatures.INT_DEFLATE)
+            writer.int32().setAttr("/watershed/levels", "levels", levels)
+        elif writer.exists("/watershed/levels"):
+            writer.delete("/watershed/levels")
+    finally:
+        writer.close()
+
+### DoG levels saved by savePeakCache, as the flat zyx short array dogLevels returns
+def loadCachedLevels(cache):
+    reader = HDF5Factory.openForReading(cache)
+    try:
+        return reader.int16().readMDArray("/watershed/levels").getAsFlatArray()
+    finally:
+        reader.close()
+
+### Single pass over the DoG planes of an ImageStack or HDF5 source, keeping only the planes still in flight.
+### Emits the mask (DoG > 0) as a 0/255 byte stack, the binary Watershed3D floods, and the peaks (DoG > cutoff
+### and not below any voxel of the neighbourhood) as a PeakList. The neighbourhood is the ellipsoid with the given
+### radii, as FastFilters3D MAXLOCAL, a box, or the separable approximation of the ellipsoid (see neighbourhoodBoxes).
+### Sources stored as int16 pass their scale, applied to the cutoff and to the peak values.
+def dogPeaks(source, radii, cutoff, scale = None, neighbourhood = "ellipsoid"):
+    (sizeX, sizeY, sizeZ) = sourceDimensions(source)
+    scale = scale or 1.0
+    maskStack = ImageStack(sizeX, sizeY)
+    peakList = PeakList(sizeX, sizeY, sizeZ)
+    if neighbourhood == "ellipsoid":
+        maxFilter = EllipsoidMax(radii, sizeX, sizeY, sizeZ)
+    else:
+        maxFilter = BoxMax(neighbourhoodBoxes(radii, neighbourhood), sizeZ)
+    window = []
+    z = 0
+    for (k, pixels) in readPlanes(source, 0, sizeZ, slab, True):
+        plane = FloatProcessor(sizeX, sizeY, pixels)
+        window.append(plane)
+        for peaks in maxFilter.add(plane):
+            plane = window.pop(0)
+            plane.setThreshold(Float.MIN_VALUE, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+            maskStack.addSlice(plane.createMask())
+            plane.resetThreshold()
+            peaks.copyBits(plane, 0, 0, Blitter.SUBTRACT)
+            seeds = planeMask(peaks, 0, 0)
+            seeds.copyBits(planeMask(plane, Math.nextUp(float(cutoff) / scale), Float.MAX_VALUE), 0, 0, Blitter.AND)
+            peakList.addPlane(z, seeds, plane, scale)
+            z += 1
+    return ImagePlus("mask", maskStack), peakList
+
+### Labels of the peaks, adjacent peaks (26-connected) sharing one label: {(x, y, z): label}
+def peakLabels(peaks):
+    parent = {}
+    def find(p):
+        while parent[p] != p:
+            parent[p] = parent[parent[p]]
+            p = parent[p]
+        return p
+    points = list(izip(peaks.x, peaks.y, peaks.z))
+    for p in points:
+        parent[p] = p
+    for (x, y, z) in points:
+        for dz in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    q = (x + dx, y + dy, z + dz)
+                    if q in parent:
+                        parent[find(q)] = find((x, y, z))
+    labels = {}
+    roots = {}
+    for p in points:
+        root = find(p)
+        if root not in roots:
+            roots[root] = len(roots) + 1
+        labels[p] = roots[root]
+    return labels
+
+### Label planes of a flat int array, 16-bit while the labels fit, 32-bit float otherwise
+def labelImage(labels, sizeX, sizeY, sizeZ, maxLabel):
+    planeSize = sizeX * sizeY
+    stack = ImageStack(sizeX, sizeY)
+    for k in range(0, sizeZ):
+        ip = FloatProcessor(sizeX, sizeY, Arrays.copyOfRange(labels, k * planeSize, (k + 1) * planeSize))
+        stack.addSlice(ip.convertToShortProcessor(False) if maxLabel < 65536 else ip)
+    return ImagePlus("watershed", stack)
+
+### DoG of an ImageStack or HDF5 source quantized into levels 0..levels-1 of its maximum, as a flat zyx short array
+def dogLevels(dogSource, levels):
+    (sizeX, sizeY, sizeZ) = sourceDimensions(dogSource)
+    planeSize = sizeX * sizeY
+    height = zeros(planeSize * sizeZ, 'h')
+    top = max([FloatProcessor(sizeX, sizeY, pixels).getMax() for (k, pixels) in readPlanes(dogSource, 0, sizeZ, slab, True)] + [1e-12])
+    for (k, pixels) in readPlanes(dogSource, 0, sizeZ, slab, True):
+        ip = FloatProcessor(sizeX, sizeY, pixels).duplicate()
+        ip.multiply((levels - 1) / top)
+        System.arraycopy(ip.convertToShortProcessor(False).getPixels(), 0, height, k * planeSize, planeSize)
+    return height
+
+### Seeded watershed of the mask from the peaks in decreasing DoG order, 6-connected. The DoG levels are inverted
+### into depths and flooded by the priority queue of the ops seeded watershed, so the flood runs on the Java side;
+### adjacent peaks share one seed label (see peakLabels). The labels are read back run by run.
+def queueWatershed(mask, peaks, height, levels):
+    if height is None:
+        raise Exception("The queue watershed needs the DoG quantized into levels, see dogLevels!")
+    stack = mask.getImageStack()
+    (sizeX, sizeY, sizeZ) = (stack.getWidth(), stack.getHeight(), stack.getSize())
+    planeSize = sizeX * sizeY
+    depthStack = ImageStack(sizeX, sizeY)
+    for k in range(0, sizeZ):
+        ip = ShortProcessor(sizeX, sizeY, Arrays.copyOfRange(height, k * planeSize, (k + 1) * planeSize), None).convertToFloat()
+        ip.multiply(-1)
+        ip.add(levels - 1)
+        depthStack.addSlice(ip)
+    depth = ImageJFunctions.wrapFloat(ImagePlus("depth", depthStack))
+    inside = ops.convert().bit(ImageJFunctions.wrapByte(mask))
+    seeds = ImgLabeling(ArrayImgs.ints(sizeX, sizeY, sizeZ))
+    access = seeds.randomAccess()
+    labels = peakLabels(peaks)
+    for ((x, y, z), label) in labels.items():
+        if stack.getProcessor(z + 1).get(x, y):
+            access.setPosition(array([x, y, z], 'l'))
+            access.get().add(Integer(label))
+    flooded = ops.image().watershed(None, depth, seeds, False, False, inside)
+    mapping = flooded.getMapping()
+    table = [0] * mapping.numSets()
+    for index in range(0, len(table)):
+        found = mapping.labelsAtIndex(index)
+        if not found.isEmpty():
+            table[index] = int(found.iterator().next())
+    indices = ImageJFunctions.wrapFloat(flooded.getIndexImg(), "indices").getImageStack()
+    result = zeros(planeSize * sizeZ, 'i')
+    for k in range(0, sizeZ):
+        for (index, y, start, end) in planeRuns(indices.getProcessor(k + 1).convertToFloat()):
+            Arrays.fill(result, k * planeSize + y * sizeX + start, k * planeSize + y * sizeX + end + 1, table[index])
+    return labelImage(result, sizeX, sizeY, sizeZ, max(labels.values() + [0]))
 
 def watershed(mask, seeds):
     water = Watershed3D(mask.getImageStack(), seeds.getImageStack(), 1.0, 1)
@@ -128,13 +1440,104 @@ def watershed(mask, seeds):
     watershed = water.getWatershedImage3D().getImagePlus()
     return watershed
 
+### Watershed of one mask component inside its bounding box, with the component's peaks in box coordinates.
+### Returns the bounds, the label image and the number of labels.
+class ComponentWatershed(Callable):
+    def __init__(self, runs, index, peaks, height, sizeX, sizeY, levels, engine):
+        self.runs = runs
+        self.index = index
+        self.peaks = peaks
+        self.height = height
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.levels = levels
+        self.engine = engine
+
+    def call(self):
+        bounds = self.runs.getBounds(self.index)
+        (x, y, z, width, height, depth) = bounds
+        stack = ImageStack(width, height)
+        for k in range(0, depth):
+            stack.addSlice(ByteProcessor(width, height))
+        planes = [stack.getProcessor(k + 1) for k in range(0, depth)]
+        for plane in planes:
+            plane.setValue(255)
+        for run in range(self.runs.offsets[self.index], self.runs.offsets[self.index + 1]):
+            plane = planes[self.runs.z[run] - z]
+            plane.setRoi(self.runs.x0[run] - x, self.runs.y[run] - y, self.runs.x1[run] - self.runs.x0[run] + 1, 1)
+            plane.fill()
+        mask = ImagePlus("component", stack)
+        if self.engine == "queue":
+            levels = zeros(width * height * depth, 'h')
+            for k in range(0, depth):
+                for j in range(0, height):
+                    System.arraycopy(self.height, ((z + k) * self.sizeY + y + j) * self.sizeX + x, levels, (k * height + j) * width, width)
+            result = queueWatershed(mask, self.peaks, levels, self.levels)
+        else:
+            seeds = self.peaks.toImage()
+            result = watershed(mask, seeds)
+            seeds.close()
+        mask.close()
+        return (bounds, result, int(StackStatistics(result).max))
+
+### Watershed of the mask flooded one connected component at a time on a thread pool. Components are labelled
+### 26-connected, which no flood crosses, and only components holding peaks are flooded. Labels are offset in
+### component order, so the result does not depend on the thread count.
+def componentWatershed(mask, peaks, dogHeight, levels, engine, ncpus):
+    stack = mask.getImageStack()
+    (sizeX, sizeY, sizeZ) = (stack.getWidth(), stack.getHeight(), stack.getSize())
+    components = ImageLabeller().getLabels(ImageHandler.wrap(mask)).getImagePlus()
+    runs = LabelRuns.fromImage(components)
+    indices = dict([(runs.getLabel(index), index) for index in range(0, runs.size())])
+    bounds = [runs.getBounds(index) for index in range(0, runs.size())]
+    local = [PeakList(box[3], box[4], box[5]) for box in bounds]
+    componentPlanes = [components.getImageStack().getProcessor(k + 1) for k in range(0, sizeZ)]
+    for (x, y, z, value) in izip(peaks.x, peaks.y, peaks.z, peaks.value):
+        label = int(componentPlanes[z].getf(x, y))
+        if label > 0:
+            index = indices[label]
+            local[index].add(x - bounds[index][0], y - bounds[index][1], z - bounds[index][2], value)
+    components.close()
+    print "Flooding " + str(len([p for p in local if p.size()])) + " of " + str(runs.size()) + " mask components"
+    pool = Executors.newFixedThreadPool(ncpus)
+    try:
+        futures = []
+        for index in range(0, runs.size()):
+            if local[index].size():
+                futures.append(pool.submit(ComponentWatershed(runs, index, local[index], dogHeight, sizeX, sizeY, levels, engine)))
+        labelStack = ImageStack(sizeX, sizeY)
+        for k in range(0, sizeZ):
+            labelStack.addSlice(FloatProcessor(sizeX, sizeY))
+        labelPlanes = [labelStack.getProcessor(k + 1) for k in range(0, sizeZ)]
+        offset = 0
+        for future in futures:
+            ((x, y, z, width, height, depth), result, count) = future.get()
+            for k in range(0, depth):
+                ip = result.getImageStack().getProcessor(k + 1).convertToFloat()
+                keep = planeMask(ip, 1, Float.MAX_VALUE).convertToFloat()
+                ip.add(offset)
+                ip.copyBits(keep, 0, 0, Blitter.MULTIPLY)
+                labelPlanes[z + k].copyBits(ip, x, y, Blitter.MAX)
+            result.close()
+            offset += count
+    finally:
+        pool.shutdown()
+    if offset < 65536:
+        for k in range(0, sizeZ):
+            labelStack.setProcessor(labelPlanes[k].convertToShortProcessor(False), k + 1)
+    return ImagePlus("watershed", labelStack)
+
 def segment(watershed):
-    objects = addVoxels(readVoxels(watershed), watershed)
-    return objects
+    runs = LabelRuns.fromImage(watershed)
+    return runs
 
-def measurements(image, watershed):
-    objects = segment(watershed)
-    measurements = getMeasurements(objects, image)
+def measurements(statistics, runs, labelImage, calibration, features, steps):
+    measurements = statistics.getResults(features)
+    if "neighbours" in features:
+        radii = [float(radius) for radius in nradii.split(",") if radius.strip()]
+        measurements = getNeighbourMeasurements(statistics, calibration, radii, measurements)
+    if "objects" in steps:
+        measurements = getShapeMeasurements(runs, "contours" in steps, labelImage, measurements)
     return measurements
 
 def weka(imp, model):
@@ -156,6 +1559,12 @@ def weka_extract(pmap, pmapidx):
     return ImagePlus("nuclei", splitter.getChannel(pmap, pmapidx + 1))
 
 
+if ncpus == 0:
+    ncpus = Runtime.getRuntime().availableProcessors()
+if wslevels < 1 or wslevels > 32767:
+    raise Exception("The watershed levels must lie between 1 and 32767, the range of the int16 levels!")
+
+(features, steps) = planMeasurements(profile)
 inhdf5 = str(inputfile)
 
 if str(outputfile):
@@ -165,74 +1574,182 @@ else:
 
 csv = hdf5.replace(".h5", ".csv")
 print "Datasets will be loaded from: " + inhdf5 +  " and saved to: " + hdf5
-print "Opening dataset: " + dsegm
-imp = HDF5ImageJ.hdf5read(inhdf5, dsegm)
-image = convert.convert(imp, Dataset)
+if task == "segment":
+    if nslabs > 1:
+        (sigmas, radii) = pixelScales(datasetCalibration(inhdf5, dsegm), sigma, radius, calibrated)
+        overlap = slaboverlap or int(math.ceil(3 * sigmas[2] + radii[2]))
+        (sizeX, sizeY, sizeZ) = sourceDimensions((inhdf5, dsegm))
+        (core, extent) = slabExtent(sizeZ, nslabs, slabindex, overlap)
+        print "Opening planes %d to %d of dataset: %s (slab %d of %d, core planes %d to %d)" % (extent[0], extent[1], dsegm, slabindex + 1, nslabs, core[0], core[1])
+        imp = readSlab(inhdf5, dsegm, extent[0], extent[1])
+    else:
+        print "Opening dataset: " + dsegm
+        imp = HDF5ImageJ.hdf5read(inhdf5, dsegm)
+
+    ### Without savedog the full-volume DoG is never kept: it is streamed through tiles of 256 like dogtile
+    tiling = dogtile if dogtile > 0 or savedog else 256
+    cacheKey = peakCacheKey()
+    height = None
+    cacheLevels = wslevels if wsengine == "queue" else 0
+    if str(peakcache) and peakCacheValid(str(peakcache), cacheKey, cutoff, cacheLevels):
+        print "Loading mask and candidate peaks from: " + str(peakcache)
+        mask = HDF5ImageJ.hdf5read(str(peakcache), "/watershed/mask")
+        candidates = PeakList.load(str(peakcache), "/watershed/peaks", imp.getWidth(), imp.getHeight(), imp.getNSlices())
+        if cacheLevels:
+            height = loadCachedLevels(str(peakcache))
+    else:
+        candidateCutoff = min(cutoff, 0.0) if str(peakcache) else cutoff
+        if str(model):
+            pmap = weka(imp, model)
+            method = "Scriptable save HDF5 (append)..."
+            options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/pmap/label{c} formatchannel=%d compressionlevel=0"
+            print "Saving probability maps to dataset: /watershed/pmap/label{c}"
+            IJ.run(pmap, method, options)
+            nuclei = weka_extract(pmap, pmapidx)
+            pmap.close()
+        else:
+            nuclei = imp
+
+        (sigmas, radii) = pixelScales(imp.getCalibration(), sigma, radius, calibrated)
+        print "DoG sigmas (x, y, z): %s, local maxima radii: %s" % (sigmas, radii)
 
-if str(model):
-    pmap = weka(imp, model)
+        if tiling > 0:
+            ### Tiles always go to a float32 dataset: the one to keep, or a scratch file removed once the peaks and
+            ### levels are read, from which an int16 copy is written with the scale of the finished DoG.
+            dogFile = hdf5 if savedog and dogstorage == "float32" else os.path.splitext(hdf5)[0] + "_dog.h5"
+            dogSource = (dogFile, "/watershed/dog")
+            print "Computing difference of gaussians in tiles of " + str(tiling) + " into: " + dogFile
+            try:
+                extent = dogTiled(nuclei, dogFile, "/watershed/dog", sigmas[0], sigmas[1], sigmas[2], div, dogmode, tiling, ncpus)
+                if savedog and dogFile != hdf5:
+                    scale = dogScale(extent)
+                    print "Saving difference of gaussians as int16 with scale %g to dataset: /watershed/dog" % scale
+                    saveDog(dogSource, hdf5, "/watershed/dog", imp.getCalibration(), scale)
+                if savedog:
+                    saveDogAttributes(hdf5, "/watershed/dog", sigmas, div)
+                (mask, candidates) = dogPeaks(dogSource, radii, candidateCutoff, None, neighbourhood)
+                if wsengine == "queue":
+                    height = dogLevels(dogSource, wslevels)
+            finally:
+                if dogFile != hdf5 and os.path.isfile(dogFile):
+                    os.remove(dogFile)
+        else:
+            dogimage = dog(convert.convert(nuclei, Dataset), sigmas[0], sigmas[1], sigmas[2], div, dogmode, ncpus)
+            dogimp = convert.convert(dogimage, ImagePlus)
+            dogStack = dogimp.getImageStack()
+            scale = None
+            if dogstorage == "int16":
+                stats = StackStatistics(dogimp)
+                scale = dogScale(max(abs(stats.min), abs(stats.max)))
+                print "DoG stored as int16 with scale %g" % scale
+            print "Saving difference of gaussians to dataset: /watershed/dog"
+            saveDog(dogStack, hdf5, "/watershed/dog", imp.getCalibration(), scale)
+            saveDogAttributes(hdf5, "/watershed/dog", sigmas, div)
+            (mask, candidates) = dogPeaks(dogStack, radii, candidateCutoff, None, neighbourhood)
+            if wsengine == "queue":
+                height = dogLevels(dogStack, wslevels)
+            dogimp.close()
+            dogimage = None
+        if nuclei is not imp:
+            nuclei.close()
+        if str(peakcache):
+            mask.copyScale(imp)
+            print "Saving mask and " + str(candidates.size()) + " candidate peaks to: " + str(peakcache)
+            savePeakCache(str(peakcache), mask, candidates, cacheKey, candidateCutoff, height, wslevels)
+    peaks = candidates.select(cutoff)
+    mask.copyScale(imp)
     method = "Scriptable save HDF5 (append)..."
-    options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/pmap/label{c} formatchannel=%d compressionlevel=0"
-    print "Saving probability maps to dataset: /watershed/pmap/label{c}"
-    IJ.run(pmap, method, options)
-    nuclei = weka_extract(pmap, pmapidx)
-    pmap.close()
-    dogimage = dog(convert.convert(nuclei, Dataset), sigma, sigma, sigma, div)
-    nuclei.close()
-else:
-    dogimage = dog(image, sigma, sigma, sigma, div)
-
-dog = convert.convert(dogimage, ImagePlus)
-dog.copyScale(imp)
-method = "Scriptable save HDF5 (append)..."
-options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/dog formatchannel=%d compressionlevel=0"
-print "Saving difference of gaussians to dataset: /watershed/dog"
-IJ.run(dog, method, options)
-
-mask = threshold(dogimage)
-mask = convert.convert(mask, ImagePlus)
-mask.copyScale(imp)
-method = "Scriptable save HDF5 (append)..."
-options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/mask formatchannel=%d compressionlevel=0"
-print "Saving mask to dataset: /watershed/mask"
-IJ.run(mask, method, options)
-dog.close()
-
-maxima = maxima(dogimage, radius, cutoff)
-maxima = convert.convert(maxima, ImagePlus)
-maxima.copyScale(imp)
-method = "Scriptable save HDF5 (append)..."
-options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/maxima formatchannel=%d compressionlevel=0"
-print "Saving local maxima to dataset: /watershed/maxima"
-IJ.run(maxima, method, options)
-
-watershed = watershed(mask, maxima)
-mask.close()
-maxima.close()
-watershed.copyScale(imp)
-imp.close()
-method = "Scriptable save HDF5 (append)..."
-options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/objects formatchannel=%d compressionlevel=0"
-print "Saving watershed to dataset: /watershed/objects"
-IJ.run(watershed, method, options)
-
-channels = []
-
-for dataset in dmeas.split(","):
-    print "Opening dataset: " + dataset.strip()
-    channel = HDF5ImageJ.hdf5read(inhdf5, dataset.strip())
-    channels.append(channel)
-image = RGBStackMerge.mergeChannels(channels, False)
-if image is None:
-    image = channels.pop()
+    options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/mask formatchannel=%d compressionlevel=0"
+    print "Saving mask to dataset: /watershed/mask"
+    IJ.run(mask, method, options)
+
+    print "Saving " + str(peaks.size()) + " local maxima to: /watershed/peaks"
+    peaks.save(hdf5, "/watershed/peaks")
+
+    if wsengine == "queue":
+        print "Flooding the mask with a hierarchical queue over " + str(wslevels) + " DoG levels"
+    if wsparallel:
+        watershed = componentWatershed(mask, peaks, height, wslevels, wsengine, ncpus)
+    elif wsengine == "queue":
+        watershed = queueWatershed(mask, peaks, height, wslevels)
+    else:
+        maxima = peaks.toImage()
+        watershed = watershed(mask, maxima)
+        maxima.close()
+    mask.close()
+    watershed.copyScale(imp)
+    imp.close()
+    method = "Scriptable save HDF5 (append)..."
+    options = "save=[" +  hdf5 + "] dsetnametemplate=/watershed/objects formatchannel=%d compressionlevel=0"
+    print "Saving watershed to dataset: /watershed/objects"
+    IJ.run(watershed, method, options)
+
+    if nslabs > 1:
+        saveSlabAttributes(hdf5, "/watershed/objects", core, extent, sizeZ, int(StackStatistics(watershed).max))
+        watershed.close()
+        print "Measurements are taken on the labels stitched by dog-stitch.py, with task=measure"
+        watershed = None
+    else:
+        calibration = watershed.getCalibration()
 else:
-    for channel in channels:
-        channel.close()
-
-results = measurements(image, watershed)
-print "Saving point cloud to file: " + csv
-results.save(csv)
-watershed.close()
-image.close()
+    watershed = None
+    calibration = datasetCalibration(hdf5, "/watershed/objects")
+
+if task == "append":
+    channelSources = [(inhdf5, dataset.strip()) for dataset in dmeas.split(",")]
+    print "Streaming channels " + dmeas + " over /watershed/objects in slabs of " + str(slab) + " planes"
+    statistics = getStatistics((hdf5, "/watershed/objects"), channelSources, ncpus, slab)
+    if not os.path.isfile(csv):
+        raise Exception("Point cloud not found: " + csv)
+    results = ResultsTable.open(csv)
+    results.showRowNumbers(False)
+    results = appendMeasurements(results, statistics, readTableLabels(hdf5, "/watershed/labels"))
+    print "Saving point cloud to file: " + csv
+    results.save(csv)
+    print "Saving point cloud columns to: /pointcloud"
+    savePointCloud(results, hdf5, "/pointcloud")
+elif task == "measure" or nslabs == 1:
+    if stream or watershed is None:
+        if watershed is not None:
+            watershed.close()
+        labelSource = (hdf5, "/watershed/objects")
+        channelSources = []
+        if "channels" in steps:
+            channelSources = [(inhdf5, dataset.strip()) for dataset in dmeas.split(",")]
+        print "Streaming measurements from HDF5 in slabs of " + str(slab) + " planes"
+        statistics = getStatistics(labelSource, channelSources, ncpus, slab)
+        runs = LabelRuns.fromHDF5(hdf5, "/watershed/objects", slab, calibration) if "objects" in steps else None
+        labelImage = None
+    else:
+        channels = []
+        image = None
+
+        if "channels" in steps:
+            for dataset in dmeas.split(","):
+                print "Opening dataset: " + dataset.strip()
+                channel = HDF5ImageJ.hdf5read(inhdf5, dataset.strip())
+                channels.append(channel)
+            image = RGBStackMerge.mergeChannels(channels, False)
+            if image is None:
+                image = channels.pop()
+            else:
+                for channel in channels:
+                    channel.close()
+
+        statistics = getStatistics(watershed.getImageStack(), getChannelStacks(image), ncpus, slab)
+        runs = segment(watershed) if "objects" in steps else None
+        labelImage = ImageInt.wrap(watershed)
+        if image:
+            image.close()
+
+    print "Saving label table to: /watershed/labels"
+    saveLabelTable(statistics, hdf5, "/watershed/labels")
+    results = measurements(statistics, runs, labelImage, calibration, features, steps)
+    print "Saving point cloud to file: " + csv
+    results.save(csv)
+    print "Saving point cloud columns to: /pointcloud"
+    savePointCloud(results, hdf5, "/pointcloud")
+    if watershed is not None and not stream:
+        watershed.close()
 
 #IJ.run("Quit")
@@ -0,0 +1,220 @@
+# @File(label="Input image") inputfile
+# @File(label="Output HDF5 name", value="") outputfile
+# @String(label="Slab HDF5 files from dog-segment.py (comma separated)", value="") slabfiles
+# @Integer(label="Slab depth",value=8) slab
+
+from itertools import izip
+from ij import ImageStack
+from ij.measure import Calibration
+from ij.plugin.filter import ThresholdToSelection
+from ij.process import Blitter, ByteProcessor, FloatProcessor, ImageProcessor, ShortProcessor
+from ch.systemsx.cisd.base.mdarray import MDIntArray
+from ch.systemsx.cisd.hdf5 import HDF5Factory, HDF5IntStorageFeatures
+from java.lang import Float
+from java.util import Arrays
+from jarray import array, zeros
+
+
+### Label values of the raw plane pixels readPlanes yields (byte, short, float or int arrays) as a float plane
+def labelProcessor(pixels, sizeX, sizeY):
+    if pixels.typecode == 'b':
+        return ByteProcessor(sizeX, sizeY, pixels).convertToFloat()
+    if pixels.typecode == 'h':
+        return ShortProcessor(sizeX, sizeY, pixels, None).convertToFloat()
+    return FloatProcessor(sizeX, sizeY, pixels)
+
+### Runs (label, y, x_start, x_end) of a label plane, found on the Java side: the pixels that differ from their
+### left neighbour start a run and are listed by ThresholdToSelection, so Jython only visits the run starts
+def planeRuns(ip):
+    (sizeX, sizeY) = (ip.getWidth(), ip.getHeight())
+    starts = FloatProcessor(sizeX, sizeY)
+    starts.copyBits(ip, 1, 0, Blitter.COPY)
+    starts.copyBits(ip, 0, 0, Blitter.DIFFERENCE)
+    starts.setThreshold(0.5, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+    roi = ThresholdToSelection().convert(starts)
+    if roi is None:
+        return []
+    points = sorted([(point.y, point.x) for point in roi.getContainedPoints()])
+    runs = []
+    for index, (y, x) in enumerate(points):
+        label = int(ip.getf(x, y))
+        if label:
+            if index + 1 < len(points) and points[index + 1][0] == y:
+                end = points[index + 1][1] - 1
+            else:
+                end = sizeX - 1
+            runs.append((label, y, x, end))
+    return runs
+
+### Yield (k, plane) for planes zmin..zmax of an ImageStack or of a zyx HDF5 dataset given as (file, dataset).
+### Datasets are read in slabs of the given depth, as float values or as int labels.
+def readPlanes(source, zmin, zmax, depth, asFloat):
+    if isinstance(source, ImageStack):
+        for k in range(zmin, zmax):
+            if asFloat:
+                yield k, source.getProcessor(k + 1).convertToFloat().getPixels()
+            else:
+                yield k, source.getPixels(k + 1)
+        return
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = [int(size) for size in reader.object().getDimensions(dataset)]
+        planeSize = sizeX * sizeY
+        for z0 in range(zmin, zmax, depth):
+            z1 = min(z0 + depth, zmax)
+            size = array([z1 - z0, sizeY, sizeX], 'i')
+            offset = array([z0, 0, 0], 'l')
+            if asFloat:
+                block = reader.float32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            else:
+                block = reader.int32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            for k in range(z0, z1):
+                start = (k - z0) * planeSize
+                yield k, Arrays.copyOfRange(block, start, start + planeSize)
+    finally:
+        reader.close()
+
+def sourceDimensions(source):
+    if isinstance(source, ImageStack):
+        return (source.getWidth(), source.getHeight(), source.getSize())
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = reader.object().getDimensions(dataset)
+    finally:
+        reader.close()
+    return (int(sizeX), int(sizeY), int(sizeZ))
+
+### Voxel size of an HDF5 dataset from its element_size_um attribute (zyx), uncalibrated when it has none
+def datasetCalibration(hdf5, dataset):
+    calibration = Calibration()
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        if reader.object().hasAttribute(dataset, "element_size_um"):
+            (calibration.pixelDepth, calibration.pixelHeight, calibration.pixelWidth) = reader.float32().getArrayAttr(dataset, "element_size_um")
+            calibration.setUnit("micron")
+    finally:
+        reader.close()
+    return calibration
+
+### Runs (p, q, y, x_start, x_end) over which two label planes both hold nonzero labels p and q. A run starts
+### wherever either plane differs from its left neighbour, found on the Java side as in planeRuns.
+def pairRuns(previous, current):
+    (sizeX, sizeY) = (current.getWidth(), current.getHeight())
+    starts = ByteProcessor(sizeX, sizeY)
+    for ip in [previous, current]:
+        changes = FloatProcessor(sizeX, sizeY)
+        changes.copyBits(ip, 1, 0, Blitter.COPY)
+        changes.copyBits(ip, 0, 0, Blitter.DIFFERENCE)
+        changes.setThreshold(0.5, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+        starts.copyBits(changes.createMask(), 0, 0, Blitter.OR)
+    starts.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+    roi = ThresholdToSelection().convert(starts)
+    if roi is None:
+        return []
+    points = sorted([(point.y, point.x) for point in roi.getContainedPoints()])
+    runs = []
+    for index, (y, x) in enumerate(points):
+        (p, q) = (int(previous.getf(x, y)), int(current.getf(x, y)))
+        if p and q:
+            if index + 1 < len(points) and points[index + 1][0] == y:
+                end = points[index + 1][1] - 1
+            else:
+                end = sizeX - 1
+            runs.append((p, q, y, x, end))
+    return runs
+
+### Label datasets of the slabs written by dog-segment.py in z order: (file, core, extent, volume depth, largest label)
+def readSlabs(files):
+    slabs = []
+    for hdf5 in files:
+        reader = HDF5Factory.openForReading(hdf5)
+        try:
+            core = tuple(reader.int32().getArrayAttr("/watershed/objects", "slab_core"))
+            extent = tuple(reader.int32().getArrayAttr("/watershed/objects", "slab_extent"))
+            sizeZ = reader.int32().getAttr("/watershed/objects", "volume_depth")
+            maxLabel = reader.int32().getAttr("/watershed/objects", "max_label")
+        finally:
+            reader.close()
+        slabs.append((hdf5, core, extent, sizeZ, maxLabel))
+    slabs.sort(key = lambda entry: entry[1][0])
+    planes = [0] + [entry[1][1] for entry in slabs]
+    if [entry[1][0] for entry in slabs] != planes[:-1] or planes[-1] != slabs[0][3]:
+        raise Exception("Slab cores do not cover planes 0 to " + str(slabs[0][3]) + ": " + str([entry[1] for entry in slabs]))
+    return slabs
+
+### Global labels carried over into a slab from the previous one. In the planes both slabs segmented, a local label
+### takes the global label of a previous label when each is the largest overlap of the other; 0 for new labels.
+def matchSlab(previous, previousLabels, current):
+    (previousFile, previousCore, previousExtent, sizeZ, previousMax) = previous
+    (currentFile, core, extent, sizeZ, maxLabel) = current
+    labels = zeros(maxLabel + 1, 'i')
+    (zmin, zmax) = (extent[0], previousExtent[1])
+    counts = {}
+    (sizeX, sizeY, depth) = sourceDimensions((currentFile, "/watershed/objects"))
+    previousPlanes = readPlanes((previousFile, "/watershed/objects"), zmin - previousExtent[0], zmax - previousExtent[0], slab, False)
+    currentPlanes = readPlanes((currentFile, "/watershed/objects"), zmin - extent[0], zmax - extent[0], slab, False)
+    for ((k, previousPixels), (j, pixels)) in izip(previousPlanes, currentPlanes):
+        for (p, q, y, start, end) in pairRuns(labelProcessor(previousPixels, sizeX, sizeY), labelProcessor(pixels, sizeX, sizeY)):
+            counts[(p, q)] = counts.get((p, q), 0) + end - start + 1
+    bestPrevious = {}
+    bestCurrent = {}
+    for ((p, q), count) in counts.items():
+        if count > bestCurrent.get(q, (0, 0))[0]:
+            bestCurrent[q] = (count, p)
+        if count > bestPrevious.get(p, (0, 0))[0]:
+            bestPrevious[p] = (count, q)
+    for (q, (count, p)) in bestCurrent.items():
+        if bestPrevious[p][1] == q:
+            labels[q] = previousLabels[p]
+    return labels
+
+### Writes the core planes of every slab with global labels into one chunked int32 label dataset, slab by slab.
+### Labels carried over keep their global label, the others are numbered in the order they first appear.
+### Planes are relabelled run by run.
+def stitchSlabs(slabs, hdf5, dataset):
+    (sizeX, sizeY, depth) = sourceDimensions((slabs[0][0], "/watershed/objects"))
+    sizeZ = slabs[0][3]
+    planeSize = sizeX * sizeY
+    calibration = datasetCalibration(slabs[0][0], "/watershed/objects")
+    writer = HDF5Factory.open(hdf5)
+    try:
+        if writer.exists(dataset):
+            writer.delete(dataset)
+        writer.int32().createMDArray(dataset, array([sizeZ, sizeY, sizeX], 'l'), array([min(slab, sizeZ), min(256, sizeY), min(256, sizeX)], 'i'), HDF5IntStorageFeatures.INT_DEFLATE)
+        writer.float32().setArrayAttr(dataset, "element_size_um", array([calibration.pixelDepth, calibration.pixelHeight, calibration.pixelWidth], 'f'))
+        nextLabel = 1
+        previous = None
+        previousLabels = None
+        for current in slabs:
+            (slabFile, core, extent, sizeZ, maxLabel) = current
+            if previous is None:
+                labels = zeros(maxLabel + 1, 'i')
+            else:
+                labels = matchSlab(previous, previousLabels, current)
+            print "Stitching planes %d to %d from %s, %d labels carried over" % (core[0], core[1], slabFile, len([label for label in labels if label]))
+            for (k, pixels) in readPlanes((slabFile, "/watershed/objects"), core[0] - extent[0], core[1] - extent[0], slab, False):
+                plane = zeros(planeSize, 'i')
+                for (label, y, start, end) in planeRuns(labelProcessor(pixels, sizeX, sizeY)):
+                    if not labels[label]:
+                        labels[label] = nextLabel
+                        nextLabel += 1
+                    Arrays.fill(plane, y * sizeX + start, y * sizeX + end + 1, labels[label])
+                writer.int32().writeMDArrayBlockWithOffset(dataset, MDIntArray(plane, array([1, sizeY, sizeX], 'i')), array([extent[0] + k, 0, 0], 'l'))
+            previous = current
+            previousLabels = labels
+    finally:
+        writer.close()
+    return (nextLabel - 1, calibration)
+
+
+if str(outputfile):
+    hdf5 = str(outputfile)
+else:
+    hdf5 = str(inputfile)
+
+slabs = readSlabs([name.strip() for name in slabfiles.split(",") if name.strip()])
+print "Stitching " + str(len(slabs)) + " slabs into dataset: /watershed/objects"
+(count, calibration) = stitchSlabs(slabs, hdf5, "/watershed/objects")
+print str(count) + " objects after stitching, measure them with dog-segment.py task=measure"
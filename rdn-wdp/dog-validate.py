@@ -0,0 +1,318 @@
+# @File(label="Input HDF5 file") inputfile
+# @String(label="Dataset", value="/raw/fused/channel1") dsegm
+# @Integer(label="DoG sigma",value=18) sigma
+# @Float(label="DoG ratio",value=4.0) div
+# @String(label="DoG modes to compare",value="recursive, pyramid, fft") dogmodes
+# @Float(label="DoG pyramid tolerance",value=0.01) dogtol
+# @Integer(label="Threads",value=0) ncpus
+# @ConvertService convert
+# @OpService ops
+
+import math, time
+from ij import ImageStack, ImagePlus
+from ij.plugin import Binner
+from ij.process import Blitter, FloatProcessor, ImageProcessor
+from java.lang import Float, Runtime, System
+from java.util import Arrays
+from java.util.concurrent import Callable, Executors
+from jarray import array, zeros
+from net.imagej import Dataset
+from net.imglib2 import FinalDimensions
+from net.imglib2.algorithm.fft2 import FFT, FFTMethods
+from net.imglib2.algorithm.gauss3 import Gauss3
+from net.imglib2.img.array import ArrayImgFactory
+from net.imglib2.img.display.imagej import ImageJFunctions
+from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
+from net.imglib2.realtransform import AffineTransform3D, RealViews
+from net.imglib2.type.numeric.complex import ComplexFloatType
+from net.imglib2.type.numeric.real import FloatType
+from net.imglib2.util import Intervals
+from net.imglib2.view import Views
+from sc.fiji.hdf5 import HDF5ImageJ
+
+
+### Young & van Vliet (1995) recursive Gaussian coefficients (B, b1, b2, b3), normalised by b0
+def recursiveCoefficients(sigma):
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * math.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+    b1 = 2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3
+    b2 = -(1.4281 * q ** 2 + 1.26661 * q ** 3)
+    b3 = 0.422205 * q ** 3
+    return (1 - (b1 + b2 + b3) / b0, b1 / b0, b2 / b0, b3 / b0)
+
+### Forward and backward third order recursion across a sequence of equally sized float arrays, in place. Every
+### step is a whole array operation on the Java side; each direction starts from its edge array.
+def recursiveSlices(slices, coefficients):
+    (B, b1, b2, b3) = coefficients
+    size = len(slices[0])
+    slices = [FloatProcessor(size, 1, values) for values in slices]
+    term = FloatProcessor(size, 1)
+    for order in [range(0, len(slices)), range(len(slices) - 1, -1, -1)]:
+        edge = slices[order[0]].duplicate()
+        history = [edge, edge, edge]
+        for t in order:
+            current = slices[t]
+            current.multiply(B)
+            for weight, previous in zip([b1, b2, b3], history):
+                term.insert(previous, 0, 0)
+                term.multiply(weight)
+                current.copyBits(term, 0, 0, Blitter.ADD)
+            history = [current, history[0], history[1]]
+
+### Filters one axis within a range of planes (x, y) or rows (z), in place. Lines along y are filtered by recursing
+### over rows gathered across the planes; planes are turned right first to filter x the same way.
+class RecursivePass(Callable):
+    def __init__(self, planes, sizeX, sizeY, axis, coefficients, first, last):
+        self.planes = planes
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.axis = axis
+        self.coefficients = coefficients
+        self.first = first
+        self.last = last
+
+    def call(self):
+        sizeX = self.sizeX
+        sizeY = self.sizeY
+        if self.axis == 2:
+            (start, end) = (self.first * sizeX, self.last * sizeX)
+            slices = [Arrays.copyOfRange(plane, start, end) for plane in self.planes]
+            recursiveSlices(slices, self.coefficients)
+            for plane, values in zip(self.planes, slices):
+                System.arraycopy(values, 0, plane, start, end - start)
+            return self
+        planes = self.planes[self.first:self.last]
+        if self.axis == 0:
+            turned = [FloatProcessor(sizeX, sizeY, plane).rotateRight() for plane in planes]
+            lines = [ip.getPixels() for ip in turned]
+            (width, height) = (sizeY, sizeX)
+        else:
+            lines = planes
+            (width, height) = (sizeX, sizeY)
+        rows = [zeros(width * len(lines), 'f') for j in range(0, height)]
+        for k, plane in enumerate(lines):
+            for j in range(0, height):
+                System.arraycopy(plane, j * width, rows[j], k * width, width)
+        recursiveSlices(rows, self.coefficients)
+        for k, plane in enumerate(lines):
+            for j in range(0, height):
+                System.arraycopy(rows[j], k * width, plane, j * width, width)
+        if self.axis == 0:
+            for plane, ip in zip(planes, turned):
+                System.arraycopy(ip.rotateLeft().getPixels(), 0, plane, 0, sizeX * sizeY)
+        return self
+
+### Gaussian blur with constant cost per voxel for any sigma, applied in place to float planes
+def gaussRecursive(planes, sizeX, sizeY, sigmas, ncpus):
+    pool = Executors.newFixedThreadPool(ncpus)
+    try:
+        for axis, sigma in enumerate(sigmas):
+            if sigma < 0.5 or (axis == 2 and len(planes) < 2):
+                continue
+            coefficients = recursiveCoefficients(sigma)
+            count = len(planes) if axis < 2 else sizeY
+            step = max(1, count / (4 * ncpus))
+            futures = []
+            for first in range(0, count, step):
+                futures.append(pool.submit(RecursivePass(planes, sizeX, sizeY, axis, coefficients, first, min(first + step, count))))
+            for future in futures:
+                future.get()
+    finally:
+        pool.shutdown()
+    return planes
+
+def floatStack(imp):
+    stack = imp.getImageStack()
+    result = ImageStack(stack.getWidth(), stack.getHeight())
+    for k in range(0, stack.getSize()):
+        ip = stack.getProcessor(k + 1)
+        result.addSlice(ip.duplicate() if ip.getBitDepth() == 32 else ip.convertToFloat())
+    return result
+
+def dogRecursive(image, sigmaA, sigmaB, ncpus):
+    imp = convert.convert(image, ImagePlus)
+    stackA = floatStack(imp)
+    stackB = floatStack(imp)
+    sizeX = stackA.getWidth()
+    sizeY = stackA.getHeight()
+    gaussRecursive([stackA.getPixels(k + 1) for k in range(0, stackA.getSize())], sizeX, sizeY, sigmaA, ncpus)
+    gaussRecursive([stackB.getPixels(k + 1) for k in range(0, stackB.getSize())], sizeX, sizeY, sigmaB, ncpus)
+    for k in range(0, stackB.getSize()):
+        stackB.getProcessor(k + 1).copyBits(stackA.getProcessor(k + 1), 0, 0, Blitter.SUBTRACT)
+    return ImageJFunctions.wrapFloat(ImagePlus("dog", stackB))
+
+### Largest downsampling factor for a Gaussian of the given sigma that keeps both the aliasing of its
+### spectrum and the linear interpolation error of the upsampled result below tol (relative amplitude)
+def pyramidFactor(sigma, tol):
+    if tol <= 0 or tol >= 1:
+        return 1
+    aliasing = math.pi * sigma / math.sqrt(2 * math.log(1 / tol))
+    interpolation = sigma * math.sqrt(8 * tol)
+    return max(1, int(min(aliasing, interpolation)))
+
+### Gaussian blur of a float image with Gauss3 on a pool of the given size, mirrored at the borders like ops gauss
+def gaussThreads(image32, sigmas, threads):
+    result = ArrayImgFactory(FloatType()).create(image32)
+    pool = Executors.newFixedThreadPool(threads)
+    try:
+        Gauss3.gauss(array(sigmas, 'd'), Views.extendMirrorSingle(image32), result, pool)
+    finally:
+        pool.shutdown()
+    return result
+
+### Gaussian blur computed on a block averaged copy and linearly interpolated back to full resolution
+def gaussPyramid(imp, sigmas, tol, threads):
+    size = [imp.getWidth(), imp.getHeight(), imp.getNSlices()]
+    factors = [min(pyramidFactor(s, tol), n) for s, n in zip(sigmas, size)]
+    if factors == [1, 1, 1]:
+        return gaussThreads(ImageJFunctions.wrapFloat(imp), sigmas, threads)
+    small = Binner().shrink(imp, factors[0], factors[1], factors[2], Binner.AVERAGE)
+    residual = [math.sqrt(max(0.0, s * s - (f * f - 1) / 12.0)) / f for s, f in zip(sigmas, factors)]
+    blurred = gaussThreads(ImageJFunctions.wrapFloat(small), residual, threads)
+    small.close()
+    (fx, fy, fz) = [float(f) for f in factors]
+    transform = AffineTransform3D()
+    transform.set(array([fx, 0, 0, (fx - 1) / 2, 0, fy, 0, (fy - 1) / 2, 0, 0, fz, (fz - 1) / 2], 'd'))
+    interpolated = Views.interpolate(Views.extendBorder(blurred), NLinearInterpolatorFactory())
+    upsampled = Views.interval(Views.raster(RealViews.affine(interpolated, transform)), [0, 0, 0], [n - 1 for n in size])
+    return ops.copy().rai(upsampled)
+
+def dogPyramid(image, sigmaA, sigmaB, tol, threads):
+    imp = ImagePlus("dog", floatStack(convert.convert(image, ImagePlus)))
+    blurA = gaussPyramid(imp, sigmaA, tol, threads)
+    blurB = gaussPyramid(imp, sigmaB, tol, threads)
+    return ops.eval("fine - coarse", {"fine": blurB, "coarse": blurA})
+
+### Mirror padding of at least 3 sigma per side, grown to sizes the FFT handles fast: (padded dimensions, interval)
+def fftPadding(image, sigmas):
+    padded = array([image.dimension(d) + 2 * int(math.ceil(3 * sigmas[d])) for d in range(0, 3)], 'l')
+    paddedDims = zeros(3, 'l')
+    fftDims = zeros(3, 'l')
+    FFTMethods.dimensionsRealToComplexFast(FinalDimensions(padded), paddedDims, fftDims)
+    return paddedDims, FFTMethods.paddingIntervalCentered(image, FinalDimensions(paddedDims))
+
+### Rough operation counts of the separable spatial DoG and of the FFT DoG, used to pick one in auto mode
+def dogCosts(image, sigmaA, sigmaB):
+    volume = float(Intervals.numElements(image))
+    taps = sum([2 * math.ceil(3 * s) + 1 for s in sigmaA + sigmaB])
+    (paddedDims, interval) = fftPadding(image, sigmaA)
+    padded = float(paddedDims[0] * paddedDims[1] * paddedDims[2])
+    return volume * taps, padded * (5 * math.log(padded, 2) + 10)
+
+### Gaussian transfer function along one axis of n samples, for the first m frequencies (folded above n / 2)
+def gaussTransfer(sigma, n, m):
+    values = []
+    for k in range(0, m):
+        w = 2 * math.pi * (k if k <= n / 2 else k - n) / n
+        values.append(math.exp(-0.5 * sigma * sigma * w * w))
+    return values
+
+### Multiplies an interleaved (re, im) ArrayImg spectrum in place by exp(-|sigmaB w|^2 / 2) - exp(-|sigmaA w|^2 / 2).
+### Both terms are separable, so the transfer function of each z plane is built from two xy base planes.
+def multiplyDogTransfer(spectrum, paddedDims, sigmaA, sigmaB):
+    (sizeX, sizeY, sizeZ) = [int(spectrum.dimension(d)) for d in range(0, 3)]
+    transfers = []
+    for sigmas in (sigmaA, sigmaB):
+        (gx, gy, gz) = [gaussTransfer(sigmas[d], int(paddedDims[d]), int(spectrum.dimension(d))) for d in range(0, 3)]
+        base = zeros(2 * sizeX * sizeY, 'f')
+        for j in range(0, sizeY):
+            for i in range(0, sizeX):
+                base[2 * (j * sizeX + i)] = base[2 * (j * sizeX + i) + 1] = gx[i] * gy[j]
+        transfers.append((FloatProcessor(2 * sizeX, sizeY, base), gz))
+    ((baseA, gzA), (baseB, gzB)) = transfers
+    storage = spectrum.update(None).getCurrentStorageArray()
+    planeSize = 2 * sizeX * sizeY
+    for k in range(0, sizeZ):
+        transfer = baseB.duplicate()
+        transfer.multiply(gzB[k])
+        coarse = baseA.duplicate()
+        coarse.multiply(gzA[k])
+        transfer.copyBits(coarse, 0, 0, Blitter.SUBTRACT)
+        plane = FloatProcessor(2 * sizeX, sizeY, Arrays.copyOfRange(storage, k * planeSize, (k + 1) * planeSize))
+        plane.copyBits(transfer, 0, 0, Blitter.MULTIPLY)
+        System.arraycopy(plane.getPixels(), 0, storage, k * planeSize, planeSize)
+
+### DoG through the frequency domain: one forward FFT of the mirror padded image, a product with the
+### analytic DoG transfer function and one inverse FFT cropped back to the image
+def dogFFT(image, sigmaA, sigmaB, ncpus):
+    image32 = ops.convert().float32(image)
+    (paddedDims, interval) = fftPadding(image32, sigmaA)
+    pool = Executors.newFixedThreadPool(ncpus)
+    try:
+        spectrum = FFT.realToComplex(Views.interval(Views.extendMirrorSingle(image32), interval), ArrayImgFactory(ComplexFloatType()), pool)
+        multiplyDogTransfer(spectrum, paddedDims, sigmaA, sigmaB)
+        result = ArrayImgFactory(FloatType()).create(image32)
+        FFT.complexToRealUnpad(spectrum, result, pool)
+    finally:
+        pool.shutdown()
+    return result
+
+### DoG with the filters of the given mode running on the given number of threads
+def dog(image, sigmaX, sigmaY, sigmaZ, div, mode = "exact", threads = 1):
+    sigmaA = [sigmaX, sigmaY, sigmaZ]
+    sigmaB = [sigmaX / div, sigmaY / div, sigmaZ / div]
+    if mode == "auto":
+        (spatial, fft) = dogCosts(image, sigmaA, sigmaB)
+        mode = "fft" if fft < spatial else "exact"
+        print "DoG mode auto: " + mode
+    if mode == "fft":
+        return dogFFT(image, sigmaA, sigmaB, threads)
+    if mode == "recursive":
+        return dogRecursive(image, sigmaA, sigmaB, threads)
+    if mode == "pyramid":
+        return dogPyramid(image, sigmaA, sigmaB, dogtol, threads)
+    image32 = ops.convert().float32(image)
+    fine = gaussThreads(image32, sigmaB, threads)
+    coarse = gaussThreads(image32, sigmaA, threads)
+    return ops.eval("fine - coarse", {"fine": fine, "coarse": coarse})
+
+### Binary 0/1 mask of a float plane for lower <= value <= upper
+def planeMask(ip, lower, upper):
+    ip.setThreshold(lower, upper, ImageProcessor.NO_LUT_UPDATE)
+    mask = ip.createMask()
+    ip.resetThreshold()
+    mask.multiply(1.0 / 255)
+    return mask
+
+### Largest deviation, reference range and fraction of voxels whose DoG sign differs, all taken on the Java side
+def compare(reference, result):
+    referenceStack = convert.convert(reference, ImagePlus).getImageStack()
+    resultStack = convert.convert(result, ImagePlus).getImageStack()
+    deviation = 0.0
+    extent = 0.0
+    flipped = 0
+    for k in range(0, referenceStack.getSize()):
+        expected = referenceStack.getProcessor(k + 1).convertToFloat()
+        actual = resultStack.getProcessor(k + 1).convertToFloat()
+        stats = expected.getStatistics()
+        extent = max(extent, abs(stats.min), abs(stats.max))
+        difference = actual.duplicate()
+        difference.copyBits(expected, 0, 0, Blitter.DIFFERENCE)
+        deviation = max(deviation, difference.getStatistics().max)
+        signs = planeMask(expected, Float.MIN_VALUE, Float.MAX_VALUE)
+        signs.copyBits(planeMask(actual, Float.MIN_VALUE, Float.MAX_VALUE), 0, 0, Blitter.DIFFERENCE)
+        flipped += signs.getHistogram()[1]
+    volume = referenceStack.getWidth() * referenceStack.getHeight() * referenceStack.getSize()
+    return deviation, extent, float(flipped) / volume
+
+if ncpus == 0:
+    ncpus = Runtime.getRuntime().availableProcessors()
+
+print "Opening dataset: " + dsegm
+imp = HDF5ImageJ.hdf5read(str(inputfile), dsegm)
+image = convert.convert(imp, Dataset)
+
+start = time.time()
+reference = dog(image, sigma, sigma, sigma, div, "exact", ncpus)
+print "exact: %.1f s" % (time.time() - start)
+
+for mode in [m.strip() for m in dogmodes.split(",") if m.strip()]:
+    start = time.time()
+    result = dog(image, sigma, sigma, sigma, div, mode, ncpus)
+    elapsed = time.time() - start
+    (deviation, extent, flipped) = compare(reference, result)
+    print "%s: %.1f s, max deviation %g (%.3g%% of range), mask changes %.3g%%" % (mode, elapsed, deviation, 100 * deviation / max(extent, 1e-12), 100 * flipped)
+imp.close()
@@ -3,11 +3,13 @@
 # @Integer(label="Minimum sigma",value=10) smin
 # @Integer(label="Maximum sigma",value=40) smax
 # @Integer(label="Step size",value=2) step
+# @Integer(label="Scale-space cache (MB)",value=4096) budget
 # @ConvertService convert
 # @DatasetService ds
 # @OpService ops
 
 import copy, math, os, sys, time
+from collections import OrderedDict
 from ij import IJ, ImageStack, ImagePlus
 from ij.plugin import Duplicator, GaussianBlur3D, ImageCalculator
 from java.lang import Runtime
@@ -16,33 +18,69 @@ from java.util.concurrent import Executors, ExecutorCompletionService
 from net.imagej import Dataset
 from net.imglib2.algorithm.gauss import Gauss
 from net.imglib2.img.array import ArrayImgFactory
+from net.imglib2.util import Intervals
 
 
+### Gaussian levels of one image, keyed by sigma. Each sigma is blurred once, from the nearest smaller
+### cached level when there is one: blurring by s1 and then by sqrt(s2^2 - s1^2) equals blurring by s2.
+### The least recently used levels are dropped when the cache outgrows its memory budget (MB).
+class ScaleSpace(object):
+    def __init__(self, image, budget):
+        self.image = ops.convert().float32(image)
+        self.capacity = max(2, int(budget * 1024 * 1024 / (4 * Intervals.numElements(self.image))))
+        self.levels = OrderedDict()
+        self.blurred = 0
+        self.derived = 0
+        self.reused = 0
+
+    def nearest(self, sigma):
+        best = None
+        for cached in self.levels:
+            if all(s * s - c * c >= 0.25 for s, c in zip(sigma, cached)):
+                if best is None or sum(c * c for c in cached) > sum(b * b for b in best):
+                    best = cached
+        return best
+
+    def level(self, sigma):
+        sigma = tuple(float(s) for s in sigma)
+        if sigma in self.levels:
+            result = self.levels.pop(sigma)
+            self.levels[sigma] = result
+            self.reused += 1
+            return result
+        base = self.nearest(sigma)
+        if base is None:
+            result = ops.eval("gauss(image, " + str(list(sigma)) + ")", {"image": self.image})
+            self.blurred += 1
+        else:
+            increment = [math.sqrt(s * s - c * c) for s, c in zip(sigma, base)]
+            result = ops.eval("gauss(image, " + str(increment) + ")", {"image": self.levels[base]})
+            self.derived += 1
+        self.levels[sigma] = result
+        while len(self.levels) > self.capacity:
+            self.levels.popitem(last = False)
+        return result
+
+    def dog(self, sigmaX, sigmaY, sigmaZ, div):
+        div = float(div)
+        coarse = self.level((sigmaX, sigmaY, sigmaZ))
+        fine = self.level((sigmaX / div, sigmaY / div, sigmaZ / div))
+        return ops.eval("fine - coarse", {"fine": fine, "coarse": coarse})
+
+
+### Saves one DoG of the sweep; the DoG itself is computed by the caller since the scale space is not thread safe
 class DogProcessor(Callable):
-    def __init__(self, image, sigma, folder):
-        self.image = image
+    def __init__(self, result, sigma, folder):
+        self.result = result
         self.sigma = sigma
         self.folder = folder
 
-    def dog(self, sigmaX, sigmaY, sigmaZ, div):
-        sigmaA = [sigmaX, sigmaY, sigmaZ]
-        sigmaB = [sigmaX / div, sigmaY / div, sigmaZ / div]
-        image32 = ops.convert().float32(self.image)
-        dogFormula = "gauss(image, " + str(sigmaB) + ") - gauss(image, " + str(sigmaA) + ")"
-        result = ops.eval(dogFormula, {"image": image32})
-        return result
-
     def call(self):  
         (sxy, foo, sz, div) = self.sigma
-        try:
-            result = self.dog(*self.sigma)
-        except Exception as e:
-            print("Error applying DOG filter: " + str(e))
-            return -1
         basename = os.path.join(self.folder, "dog-" + str(sxy) + "_" + str(sz) + "_" + str(div))
         tiff = basename + ".tiff"
         try:
-            dataset = ds.create(result)
+            dataset = ds.create(self.result)
             ds.save(dataset, tiff)
         except Exception as e:
             print("Error saving result image: " + str(e))
@@ -56,7 +94,9 @@ def main():
         print("Error opening image: " + str(e))
         return -1
     
-    pool = Executors.newFixedThreadPool(Runtime.getRuntime().availableProcessors() - 2)
+    scaleSpace = ScaleSpace(image, budget)
+    threads = max(1, Runtime.getRuntime().availableProcessors() - 2)
+    pool = Executors.newFixedThreadPool(threads)
     ecs = ExecutorCompletionService(pool)
     sigmas = []
     for sxy in range(smin, smax+1, step):
@@ -64,17 +104,27 @@ def main():
             for div in [1.5, 2, 3, 4]:
                 sigma = (sxy, sxy, sz, div)
                 sigmas.append(sigma)
+    sigmas.sort(key = lambda s: (s[0] ** 2 + s[1] ** 2 + s[2] ** 2, -s[3]))
     
     submitted = 0   
     for sigma in sigmas:
-        ecs.submit(DogProcessor(image, sigma, folder))
+        try:
+            result = scaleSpace.dog(*sigma)
+        except Exception as e:
+            print("Error applying DOG filter: " + str(e))
+            continue
+        ecs.submit(DogProcessor(result, sigma, folder))
         submitted += 1
+        if submitted > threads:
+            ecs.take().get()
+            submitted -= 1
     
     while submitted > 0:
         result = ecs.take().get()
         submitted -= 1
     
     pool.shutdown()
+    print "Scale space: %d levels blurred, %d derived from cached levels, %d reused" % (scaleSpace.blurred, scaleSpace.derived, scaleSpace.reused)
     return 0
 
 if __name__ == "__main__" or __name__ == "__builtin__":
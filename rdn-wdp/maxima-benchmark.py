@@ -0,0 +1,338 @@
+# @File(label="Input HDF5 file") inputfile
+# @String(label="DoG dataset", value="/watershed/dog") ddog
+# @String(label="Local maxima radii",value="2, 3, 5, 7, 10") radiilist
+# @Float(label="Maxima cutoff",value=0.0) cutoff
+# @String(label="Neighbourhoods",value="ellipsoid, box, approx") neighbourhoods
+# @Integer(label="Slab depth",value=8) slab
+
+import math, time
+from itertools import izip
+from ij import ImageStack, ImagePlus
+from ij.plugin.filter import ThresholdToSelection
+from ij.process import Blitter, ByteProcessor, FloatProcessor, ImageProcessor
+from ch.systemsx.cisd.hdf5 import HDF5Factory
+from java.lang import Float, Math, Runtime, System
+from java.util import Arrays
+from jarray import array, zeros
+from mcib3d.image3d.processing import FastFilters3D
+from sc.fiji.hdf5 import HDF5ImageJ
+
+
+### Yield (k, plane) for planes zmin..zmax of an ImageStack or of a zyx HDF5 dataset given as (file, dataset).
+### Datasets are read in slabs of the given depth, as float values or as int labels.
+def readPlanes(source, zmin, zmax, depth, asFloat):
+    if isinstance(source, ImageStack):
+        for k in range(zmin, zmax):
+            if asFloat:
+                yield k, source.getProcessor(k + 1).convertToFloat().getPixels()
+            else:
+                yield k, source.getPixels(k + 1)
+        return
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = [int(size) for size in reader.object().getDimensions(dataset)]
+        planeSize = sizeX * sizeY
+        for z0 in range(zmin, zmax, depth):
+            z1 = min(z0 + depth, zmax)
+            size = array([z1 - z0, sizeY, sizeX], 'i')
+            offset = array([z0, 0, 0], 'l')
+            if asFloat:
+                block = reader.float32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            else:
+                block = reader.int32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            for k in range(z0, z1):
+                start = (k - z0) * planeSize
+                yield k, Arrays.copyOfRange(block, start, start + planeSize)
+    finally:
+        reader.close()
+
+def sourceDimensions(source):
+    if isinstance(source, ImageStack):
+        return (source.getWidth(), source.getHeight(), source.getSize())
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = reader.object().getDimensions(dataset)
+    finally:
+        reader.close()
+    return (int(sizeX), int(sizeY), int(sizeZ))
+
+### Rows of the ellipsoid with radii (rx, ry, rz) grouped by half width: {w: [(dz, dy), ...]}
+def ballRows(radii):
+    (rx, ry, rz) = radii
+    rows = {}
+    for dz in range(-int(rz), int(rz) + 1):
+        for dy in range(-int(ry), int(ry) + 1):
+            remainder = 1.0
+            if dy:
+                remainder -= (float(dy) / ry) ** 2
+            if dz:
+                remainder -= (float(dz) / rz) ** 2
+            if remainder >= 0:
+                w = int(rx * math.sqrt(remainder) + 1e-9)
+                rows.setdefault(w, []).append((dz, dy))
+    return rows
+
+### Running maxima over the ellipsoid with the given radii along a stream of n float planes. Each added plane
+### is max filtered along x for growing half widths and shifted into the maxima of the output planes it
+### reaches; add() returns the output planes completed so far, in order.
+class EllipsoidMax():
+    def __init__(self, radii, sizeX, sizeY, n):
+        self.rows = ballRows(radii)
+        self.rx = int(radii[0])
+        self.depth = int(radii[2])
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.n = n
+        self.ball = {}
+        self.count = 0
+        self.emitted = 0
+
+    def add(self, plane):
+        k = self.count
+        self.count += 1
+        for z in range(k, min(k + self.depth + 1, self.n)):
+            if z not in self.ball:
+                self.ball[z] = FloatProcessor(self.sizeX, self.sizeY)
+                self.ball[z].setValue(-Float.MAX_VALUE)
+                self.ball[z].fill()
+        line = plane.duplicate()
+        for w in range(0, self.rx + 1):
+            if w > 0:
+                line.copyBits(plane, w, 0, Blitter.MAX)
+                line.copyBits(plane, -w, 0, Blitter.MAX)
+            for (dz, dy) in self.rows.get(w, []):
+                if k - dz in self.ball:
+                    self.ball[k - dz].copyBits(line, 0, dy, Blitter.MAX)
+        last = self.n - 1 if k == self.n - 1 else k - self.depth
+        outputs = []
+        while self.emitted <= last:
+            outputs.append(self.ball.pop(self.emitted))
+            self.emitted += 1
+        return outputs
+
+### van Herk / Gil-Werman running maximum over windows of 2 * r + 1 slices, clipped at both ends, along a
+### stream of n equally sized float processors. Prefix maxima (g) run within blocks of 2 * r + 1 slices and
+### suffix maxima (h) are filled in when a block is complete; each window is max(h[a], g[b]), so every slice
+### costs a fixed number of Blitter.MAX operations for any r. add() returns the completed maxima, in order.
+class RunningMax():
+    def __init__(self, r, n):
+        self.r = r
+        self.k = 2 * r + 1
+        self.n = n
+        self.g = None
+        self.h = {}
+        self.block = []
+        self.count = 0
+        self.emitted = 0
+
+    def add(self, ip):
+        j = self.count
+        self.count += 1
+        if j % self.k == 0:
+            self.g = ip.duplicate()
+        else:
+            self.g.copyBits(ip, 0, 0, Blitter.MAX)
+        self.block.append(ip)
+        if j % self.k == self.k - 1 or j == self.n - 1:
+            start = j - len(self.block) + 1
+            suffix = self.block[-1].duplicate()
+            self.h[j] = suffix
+            for t in range(len(self.block) - 2, -1, -1):
+                suffix = suffix.duplicate()
+                suffix.copyBits(self.block[t], 0, 0, Blitter.MAX)
+                self.h[start + t] = suffix
+            self.block = []
+        outputs = []
+        while self.emitted < self.n and (self.emitted + self.r <= j or j == self.n - 1):
+            a = self.emitted - self.r
+            b = min(self.emitted + self.r, self.n - 1)
+            if a <= 0:
+                result = self.g.duplicate()
+            elif a / self.k == b / self.k:
+                result = self.h.pop(a)
+            else:
+                result = self.h.pop(a)
+                result.copyBits(self.g, 0, 0, Blitter.MAX)
+            outputs.append(result)
+            self.emitted += 1
+        for a in [a for a in self.h if a < self.emitted - self.r]:
+            del self.h[a]
+        return outputs
+
+### Running maximum along y over windows of 2 * r + 1 rows of a float processor
+def rowMax(ip, r):
+    if r <= 0:
+        return ip
+    (w, h) = (ip.getWidth(), ip.getHeight())
+    pixels = ip.getPixels()
+    result = zeros(w * h, 'f')
+    running = RunningMax(r, h)
+    y = 0
+    for j in range(0, h):
+        for row in running.add(FloatProcessor(w, 1, Arrays.copyOfRange(pixels, j * w, (j + 1) * w))):
+            System.arraycopy(row.getPixels(), 0, result, y * w, w)
+            y += 1
+    return FloatProcessor(w, h, result)
+
+### Running maxima over the union of boxes with half sizes (rx, ry, rz), each separable into x and y passes per
+### plane and a z pass over the stream, all of them van Herk / Gil-Werman running maxima
+class BoxMax():
+    def __init__(self, boxes, n):
+        self.boxes = boxes
+        self.running = [RunningMax(rz, n) for (rx, ry, rz) in boxes]
+        self.queues = [[] for box in boxes]
+
+    def add(self, plane):
+        for (rx, ry, rz), running, queue in izip(self.boxes, self.running, self.queues):
+            filtered = plane
+            if rx > 0:
+                filtered = rowMax(filtered.rotateLeft(), rx).rotateRight()
+            filtered = rowMax(filtered, ry)
+            queue.extend(running.add(filtered))
+        outputs = []
+        while all(self.queues):
+            result = self.queues[0].pop(0)
+            for queue in self.queues[1:]:
+                result.copyBits(queue.pop(0), 0, 0, Blitter.MAX)
+            outputs.append(result)
+        return outputs
+
+### Boxes of a local maxima neighbourhood: a single box with the given radii, or a union of four boxes
+### inscribed in the ellipsoid (a cube and three plates) as its separable approximation
+def neighbourhoodBoxes(radii, neighbourhood):
+    if neighbourhood == "box":
+        factors = [(1.0, 1.0, 1.0)]
+    else:
+        factors = [(0.577, 0.577, 0.577), (0.8, 0.42, 0.42), (0.42, 0.8, 0.42), (0.42, 0.42, 0.8)]
+    return [tuple([int(f * r + 1e-9) for f, r in zip(factor, radii)]) for factor in factors]
+
+### Binary 0/1 mask of a float plane for lower <= value <= upper
+def planeMask(ip, lower, upper):
+    ip.setThreshold(lower, upper, ImageProcessor.NO_LUT_UPDATE)
+    mask = ip.createMask()
+    ip.resetThreshold()
+    mask.multiply(1.0 / 255)
+    return mask
+
+### Local maxima of a volume as a compact list of voxel coordinates and DoG values
+class PeakList():
+    def __init__(self, sizeX, sizeY, sizeZ):
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.sizeZ = sizeZ
+        self.x = []
+        self.y = []
+        self.z = []
+        self.value = []
+
+    def size(self):
+        return len(self.x)
+
+    def add(self, x, y, z, value):
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+        self.value.append(value)
+
+    ### Adds the set pixels of a 0/1 seed plane with their values in the DoG plane
+    def addPlane(self, k, seeds, plane, scale):
+        seeds.setThreshold(1, 255, ImageProcessor.NO_LUT_UPDATE)
+        roi = ThresholdToSelection().convert(seeds)
+        seeds.resetThreshold()
+        if roi is None:
+            return
+        for point in roi.getContainedPoints():
+            self.add(point.x, point.y, k, plane.getf(point.x, point.y) * scale)
+
+    ### Dense 0/255 seed image like the thresholded maxima, above the seeds threshold of Watershed3D; only built for it
+    def toImage(self):
+        stack = ImageStack(self.sizeX, self.sizeY)
+        planes = [ByteProcessor(self.sizeX, self.sizeY) for k in range(0, self.sizeZ)]
+        for plane in planes:
+            stack.addSlice(plane)
+        for (x, y, z) in izip(self.x, self.y, self.z):
+            planes[z].set(x, y, 255)
+        return ImagePlus("maxima", stack)
+
+    def save(self, hdf5, group):
+        writer = HDF5Factory.open(hdf5)
+        try:
+            writer.int32().writeArray(group + "/x", array(self.x, 'i'))
+            writer.int32().writeArray(group + "/y", array(self.y, 'i'))
+            writer.int32().writeArray(group + "/z", array(self.z, 'i'))
+            writer.float32().writeArray(group + "/value", array(self.value, 'f'))
+        finally:
+            writer.close()
+
+### Single pass over the DoG planes of an ImageStack or HDF5 source, keeping only the planes still in flight.
+### Emits the mask (DoG > 0) as a 0/255 byte stack, the binary Watershed3D floods, and the peaks (DoG > cutoff
+### and not below any voxel of the neighbourhood) as a PeakList. The neighbourhood is the ellipsoid with the given
+### radii, as FastFilters3D MAXLOCAL, a box, or the separable approximation of the ellipsoid (see neighbourhoodBoxes).
+### Sources stored as int16 pass their scale, applied to the cutoff and to the peak values.
+def dogPeaks(source, radii, cutoff, scale = None, neighbourhood = "ellipsoid"):
+    (sizeX, sizeY, sizeZ) = sourceDimensions(source)
+    scale = scale or 1.0
+    maskStack = ImageStack(sizeX, sizeY)
+    peakList = PeakList(sizeX, sizeY, sizeZ)
+    if neighbourhood == "ellipsoid":
+        maxFilter = EllipsoidMax(radii, sizeX, sizeY, sizeZ)
+    else:
+        maxFilter = BoxMax(neighbourhoodBoxes(radii, neighbourhood), sizeZ)
+    window = []
+    z = 0
+    for (k, pixels) in readPlanes(source, 0, sizeZ, slab, True):
+        plane = FloatProcessor(sizeX, sizeY, pixels)
+        window.append(plane)
+        for peaks in maxFilter.add(plane):
+            plane = window.pop(0)
+            plane.setThreshold(Float.MIN_VALUE, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+            maskStack.addSlice(plane.createMask())
+            plane.resetThreshold()
+            peaks.copyBits(plane, 0, 0, Blitter.SUBTRACT)
+            seeds = planeMask(peaks, 0, 0)
+            seeds.copyBits(planeMask(plane, Math.nextUp(float(cutoff) / scale), Float.MAX_VALUE), 0, 0, Blitter.AND)
+            peakList.addPlane(z, seeds, plane, scale)
+            z += 1
+    return ImagePlus("mask", maskStack), peakList
+
+
+### Peaks of FastFilters3D MAXLOCAL above the cutoff, the filter dogPeaks replaces
+def maxlocalPeaks(stack, radius, cutoff):
+    filters = FastFilters3D()
+    filtered = filters.filterImageStack(stack, FastFilters3D.MAXLOCAL, radius, radius, radius, Runtime.getRuntime().availableProcessors(), True)
+    peakList = PeakList(stack.getWidth(), stack.getHeight(), stack.getSize())
+    for k in range(0, filtered.getSize()):
+        plane = filtered.getProcessor(k + 1).convertToFloat()
+        peakList.addPlane(k, planeMask(plane, Math.nextUp(float(cutoff)), Float.MAX_VALUE), plane, 1.0)
+    return peakList
+
+### Scale of a DoG dataset stored as int16 (DoG = value * scale), None for float32
+def datasetScale(hdf5, dataset):
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        if reader.object().hasAttribute(dataset, "scale"):
+            return reader.float64().getAttr(dataset, "scale")
+    finally:
+        reader.close()
+    return None
+
+def peakSet(peakList):
+    return set(izip(peakList.x, peakList.y, peakList.z))
+
+
+source = (str(inputfile), ddog)
+scale = datasetScale(str(inputfile), ddog)
+print "Opening dataset: " + ddog + (" (int16, scale %g)" % scale if scale else "")
+stack = HDF5ImageJ.hdf5read(str(inputfile), ddog).getImageStack()
+for radius in [int(r) for r in radiilist.split(",") if r.strip()]:
+    start = time.time()
+    reference = peakSet(maxlocalPeaks(stack, radius, cutoff / (scale or 1.0)))
+    print "radius %d, MAXLOCAL: %.1f s, %d peaks" % (radius, time.time() - start, len(reference))
+    for neighbourhood in [n.strip() for n in neighbourhoods.split(",") if n.strip()]:
+        start = time.time()
+        (mask, peaks) = dogPeaks(source, [float(radius)] * 3, cutoff, scale, neighbourhood)
+        elapsed = time.time() - start
+        found = peakSet(peaks)
+        print "radius %d, %s: %.1f s, %d peaks, %d shared with MAXLOCAL" % (radius, neighbourhood, elapsed, len(found), len(found & reference))
@@ -0,0 +1,304 @@
+# @File(label="Segmentation HDF5 file") inputfile
+# @String(label="Watershed levels to compare",value="64, 256, 1024") levellist
+# @Integer(label="Slab depth",value=8) slab
+# @OpService ops
+
+import time
+from itertools import izip
+from ij import ImageStack, ImagePlus
+from ij.plugin.filter import ThresholdToSelection
+from ij.process import Blitter, ByteProcessor, FloatProcessor, ImageProcessor, ShortProcessor
+from ch.systemsx.cisd.hdf5 import HDF5Factory
+from java.lang import Float, Integer, System
+from java.util import Arrays
+from jarray import array, zeros
+from mcib3d.image3d.regionGrowing import Watershed3D
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.img.display.imagej import ImageJFunctions
+from net.imglib2.roi.labeling import ImgLabeling
+from sc.fiji.hdf5 import HDF5ImageJ
+
+
+### Yield (k, plane) for planes zmin..zmax of an ImageStack or of a zyx HDF5 dataset given as (file, dataset).
+### Datasets are read in slabs of the given depth, as float values or as int labels.
+def readPlanes(source, zmin, zmax, depth, asFloat):
+    if isinstance(source, ImageStack):
+        for k in range(zmin, zmax):
+            if asFloat:
+                yield k, source.getProcessor(k + 1).convertToFloat().getPixels()
+            else:
+                yield k, source.getPixels(k + 1)
+        return
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = [int(size) for size in reader.object().getDimensions(dataset)]
+        planeSize = sizeX * sizeY
+        for z0 in range(zmin, zmax, depth):
+            z1 = min(z0 + depth, zmax)
+            size = array([z1 - z0, sizeY, sizeX], 'i')
+            offset = array([z0, 0, 0], 'l')
+            if asFloat:
+                block = reader.float32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            else:
+                block = reader.int32().readMDArrayBlockWithOffset(dataset, size, offset).getAsFlatArray()
+            for k in range(z0, z1):
+                start = (k - z0) * planeSize
+                yield k, Arrays.copyOfRange(block, start, start + planeSize)
+    finally:
+        reader.close()
+
+def sourceDimensions(source):
+    if isinstance(source, ImageStack):
+        return (source.getWidth(), source.getHeight(), source.getSize())
+    (hdf5, dataset) = source
+    reader = HDF5Factory.openForReading(hdf5)
+    try:
+        (sizeZ, sizeY, sizeX) = reader.object().getDimensions(dataset)
+    finally:
+        reader.close()
+    return (int(sizeX), int(sizeY), int(sizeZ))
+
+### Local maxima of a volume as a compact list of voxel coordinates and DoG values
+class PeakList():
+    def __init__(self, sizeX, sizeY, sizeZ):
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.sizeZ = sizeZ
+        self.x = []
+        self.y = []
+        self.z = []
+        self.value = []
+
+    def size(self):
+        return len(self.x)
+
+    def add(self, x, y, z, value):
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+        self.value.append(value)
+
+    ### Adds the set pixels of a 0/1 seed plane with their values in the DoG plane
+    def addPlane(self, k, seeds, plane, scale):
+        seeds.setThreshold(1, 255, ImageProcessor.NO_LUT_UPDATE)
+        roi = ThresholdToSelection().convert(seeds)
+        seeds.resetThreshold()
+        if roi is None:
+            return
+        for point in roi.getContainedPoints():
+            self.add(point.x, point.y, k, plane.getf(point.x, point.y) * scale)
+
+    ### Dense 0/255 seed image like the thresholded maxima, above the seeds threshold of Watershed3D; only built for it
+    def toImage(self):
+        stack = ImageStack(self.sizeX, self.sizeY)
+        planes = [ByteProcessor(self.sizeX, self.sizeY) for k in range(0, self.sizeZ)]
+        for plane in planes:
+            stack.addSlice(plane)
+        for (x, y, z) in izip(self.x, self.y, self.z):
+            planes[z].set(x, y, 255)
+        return ImagePlus("maxima", stack)
+
+    def save(self, hdf5, group):
+        writer = HDF5Factory.open(hdf5)
+        try:
+            writer.int32().writeArray(group + "/x", array(self.x, 'i'))
+            writer.int32().writeArray(group + "/y", array(self.y, 'i'))
+            writer.int32().writeArray(group + "/z", array(self.z, 'i'))
+            writer.float32().writeArray(group + "/value", array(self.value, 'f'))
+        finally:
+            writer.close()
+
+    @classmethod
+    def load(cls, hdf5, group, sizeX, sizeY, sizeZ):
+        peaks = cls(sizeX, sizeY, sizeZ)
+        reader = HDF5Factory.openForReading(hdf5)
+        try:
+            peaks.x = list(reader.int32().readArray(group + "/x"))
+            peaks.y = list(reader.int32().readArray(group + "/y"))
+            peaks.z = list(reader.int32().readArray(group + "/z"))
+            peaks.value = list(reader.float32().readArray(group + "/value"))
+        finally:
+            reader.close()
+        return peaks
+
+    ### Peaks with a value above the cutoff
+    def select(self, cutoff):
+        peaks = PeakList(self.sizeX, self.sizeY, self.sizeZ)
+        for (x, y, z, value) in izip(self.x, self.y, self.z, self.value):
+            if value > cutoff:
+                peaks.add(x, y, z, value)
+        return peaks
+
+### Labels of the peaks, adjacent peaks (26-connected) sharing one label: {(x, y, z): label}
+def peakLabels(peaks):
+    parent = {}
+    def find(p):
+        while parent[p] != p:
+            parent[p] = parent[parent[p]]
+            p = parent[p]
+        return p
+    points = list(izip(peaks.x, peaks.y, peaks.z))
+    for p in points:
+        parent[p] = p
+    for (x, y, z) in points:
+        for dz in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    q = (x + dx, y + dy, z + dz)
+                    if q in parent:
+                        parent[find(q)] = find((x, y, z))
+    labels = {}
+    roots = {}
+    for p in points:
+        root = find(p)
+        if root not in roots:
+            roots[root] = len(roots) + 1
+        labels[p] = roots[root]
+    return labels
+
+### Label planes of a flat int array, 16-bit while the labels fit, 32-bit float otherwise
+def labelImage(labels, sizeX, sizeY, sizeZ, maxLabel):
+    planeSize = sizeX * sizeY
+    stack = ImageStack(sizeX, sizeY)
+    for k in range(0, sizeZ):
+        ip = FloatProcessor(sizeX, sizeY, Arrays.copyOfRange(labels, k * planeSize, (k + 1) * planeSize))
+        stack.addSlice(ip.convertToShortProcessor(False) if maxLabel < 65536 else ip)
+    return ImagePlus("watershed", stack)
+
+### DoG of an ImageStack or HDF5 source quantized into levels 0..levels-1 of its maximum, as a flat zyx short array
+def dogLevels(dogSource, levels):
+    (sizeX, sizeY, sizeZ) = sourceDimensions(dogSource)
+    planeSize = sizeX * sizeY
+    height = zeros(planeSize * sizeZ, 'h')
+    top = max([FloatProcessor(sizeX, sizeY, pixels).getMax() for (k, pixels) in readPlanes(dogSource, 0, sizeZ, slab, True)] + [1e-12])
+    for (k, pixels) in readPlanes(dogSource, 0, sizeZ, slab, True):
+        ip = FloatProcessor(sizeX, sizeY, pixels).duplicate()
+        ip.multiply((levels - 1) / top)
+        System.arraycopy(ip.convertToShortProcessor(False).getPixels(), 0, height, k * planeSize, planeSize)
+    return height
+
+### Runs (label, y, x_start, x_end) of a label plane, found on the Java side: the pixels that differ from their
+### left neighbour start a run and are listed by ThresholdToSelection, so Jython only visits the run starts
+def planeRuns(ip):
+    (sizeX, sizeY) = (ip.getWidth(), ip.getHeight())
+    starts = FloatProcessor(sizeX, sizeY)
+    starts.copyBits(ip, 1, 0, Blitter.COPY)
+    starts.copyBits(ip, 0, 0, Blitter.DIFFERENCE)
+    starts.setThreshold(0.5, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+    roi = ThresholdToSelection().convert(starts)
+    if roi is None:
+        return []
+    points = sorted([(point.y, point.x) for point in roi.getContainedPoints()])
+    runs = []
+    for index, (y, x) in enumerate(points):
+        label = int(ip.getf(x, y))
+        if label:
+            if index + 1 < len(points) and points[index + 1][0] == y:
+                end = points[index + 1][1] - 1
+            else:
+                end = sizeX - 1
+            runs.append((label, y, x, end))
+    return runs
+
+### Yield (k, plane) for planes zmin..zmax of an ImageStack or of a zyx HDF5 dataset given as (file, dataset).
+### Datasets are read in slabs of the given depth, as float values or as int labels.
+### Seeded watershed of the mask from the peaks in decreasing DoG order, 6-connected. The DoG levels are inverted
+### into depths and flooded by the priority queue of the ops seeded watershed, so the flood runs on the Java side;
+### adjacent peaks share one seed label (see peakLabels). The labels are read back run by run.
+def queueWatershed(mask, peaks, height, levels):
+    if height is None:
+        raise Exception("The queue watershed needs the DoG quantized into levels, see dogLevels!")
+    stack = mask.getImageStack()
+    (sizeX, sizeY, sizeZ) = (stack.getWidth(), stack.getHeight(), stack.getSize())
+    planeSize = sizeX * sizeY
+    depthStack = ImageStack(sizeX, sizeY)
+    for k in range(0, sizeZ):
+        ip = ShortProcessor(sizeX, sizeY, Arrays.copyOfRange(height, k * planeSize, (k + 1) * planeSize), None).convertToFloat()
+        ip.multiply(-1)
+        ip.add(levels - 1)
+        depthStack.addSlice(ip)
+    depth = ImageJFunctions.wrapFloat(ImagePlus("depth", depthStack))
+    inside = ops.convert().bit(ImageJFunctions.wrapByte(mask))
+    seeds = ImgLabeling(ArrayImgs.ints(sizeX, sizeY, sizeZ))
+    access = seeds.randomAccess()
+    labels = peakLabels(peaks)
+    for ((x, y, z), label) in labels.items():
+        if stack.getProcessor(z + 1).get(x, y):
+            access.setPosition(array([x, y, z], 'l'))
+            access.get().add(Integer(label))
+    flooded = ops.image().watershed(None, depth, seeds, False, False, inside)
+    mapping = flooded.getMapping()
+    table = [0] * mapping.numSets()
+    for index in range(0, len(table)):
+        found = mapping.labelsAtIndex(index)
+        if not found.isEmpty():
+            table[index] = int(found.iterator().next())
+    indices = ImageJFunctions.wrapFloat(flooded.getIndexImg(), "indices").getImageStack()
+    result = zeros(planeSize * sizeZ, 'i')
+    for k in range(0, sizeZ):
+        for (index, y, start, end) in planeRuns(indices.getProcessor(k + 1).convertToFloat()):
+            Arrays.fill(result, k * planeSize + y * sizeX + start, k * planeSize + y * sizeX + end + 1, table[index])
+    return labelImage(result, sizeX, sizeY, sizeZ, max(labels.values() + [0]))
+
+def watershed(mask, seeds):
+    water = Watershed3D(mask.getImageStack(), seeds.getImageStack(), 1.0, 1)
+    water.setLabelSeeds(True)
+    watershed = water.getWatershedImage3D().getImagePlus()
+    return watershed
+
+### One-to-one agreement of two label stacks: the fraction of voxels labelled in either that lie in a pair of labels
+### each being the other's largest overlap. Also counts reference objects split over several result labels and
+### result labels merging several reference objects, each judged by the best match of the smaller pieces.
+def agreement(reference, result):
+    counts = {}
+    total = 0
+    for k in range(0, reference.getSize()):
+        expected = reference.getProcessor(k + 1).convertToFloat().getPixels()
+        actual = result.getProcessor(k + 1).convertToFloat().getPixels()
+        for (a, b) in izip(expected, actual):
+            if a > 0 or b > 0:
+                total += 1
+                if a > 0 and b > 0:
+                    counts[(a, b)] = counts.get((a, b), 0) + 1
+    bestResult = {}
+    bestReference = {}
+    for ((a, b), count) in counts.items():
+        if count > bestResult.get(a, (0, 0))[0]:
+            bestResult[a] = (count, b)
+        if count > bestReference.get(b, (0, 0))[0]:
+            bestReference[b] = (count, a)
+    matched = sum([count for (a, (count, b)) in bestResult.items() if bestReference[b][1] == a])
+    pieces = {}
+    for (b, (count, a)) in bestReference.items():
+        pieces[a] = pieces.get(a, 0) + 1
+    splits = len([a for a in pieces if pieces[a] > 1])
+    parts = {}
+    for (a, (count, b)) in bestResult.items():
+        parts[b] = parts.get(b, 0) + 1
+    merges = len([b for b in parts if parts[b] > 1])
+    return (float(matched) / max(total, 1), splits, merges)
+
+hdf5 = str(inputfile)
+mask = HDF5ImageJ.hdf5read(hdf5, "/watershed/mask")
+stack = mask.getImageStack()
+peaks = PeakList.load(hdf5, "/watershed/peaks", stack.getWidth(), stack.getHeight(), stack.getSize())
+print "Loaded mask and " + str(peaks.size()) + " peaks"
+
+start = time.time()
+maxima = peaks.toImage()
+reference = watershed(mask, maxima).getImageStack()
+maxima.close()
+print "Watershed3D: %.1f s" % (time.time() - start)
+
+for levels in [int(level) for level in levellist.split(",") if level.strip()]:
+    if levels < 1 or levels > 32767:
+        raise Exception("The watershed levels must lie between 1 and 32767, the range of the int16 levels!")
+    start = time.time()
+    result = queueWatershed(mask, peaks, dogLevels((hdf5, "/watershed/dog"), levels), levels).getImageStack()
+    elapsed = time.time() - start
+    print "queue, %d levels: %.1f s, one-to-one agreement %.4f, %d splits, %d merges" % ((levels, elapsed) + agreement(reference, result))
+start = time.time()
+result = queueWatershed(mask, peaks, zeros(stack.getWidth() * stack.getHeight() * stack.getSize(), 'h'), 1).getImageStack()
+elapsed = time.time() - start
+print "queue, mask only: %.1f s, one-to-one agreement %.4f, %d splits, %d merges" % ((elapsed,) + agreement(reference, result))